@@ -0,0 +1,16 @@
+# ai_client.py
+import streamlit as st
+
+
+# ★OpenAI クライアントはプロセスで共有する（接続プールを使い回すため）
+# openai の import も重いので、初回利用時（またはウォームアップ時）まで遅らせる
+@st.cache_resource
+def get_openai_client():
+    api_key = st.secrets.get("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    try:
+        from openai import OpenAI
+    except ImportError:
+        return None
+    return OpenAI(api_key=api_key)
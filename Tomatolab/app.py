@@ -1,11 +1,27 @@
 import base64
+import secrets
 import time
-from pathlib import Path
 import streamlit as st
 import streamlit.components.v1 as components
 from dotenv import load_dotenv
-from auth_gate import security_gate
+from auth_gate import logout, security_gate
 from sheets_utils import save_log_to_sheet
+from quota_ledger import QuotaExceeded, get_quota_ledger
+from theme import build_background_html, theme_marker_html
+from ai_client import get_openai_client
+from model_router import (
+    choose_route,
+    estimate_completion_tokens,
+    estimate_prompt_tokens,
+    stream_chat,
+)
+from transcript_store import get_transcript_store
+from log_export import render_export_panel
+from image_jobs import ImageJobsBusy, get_image_job_runner
+from history_store import HISTORY_PAGE_SIZE, get_history_store, load_history_image
+from warmup import start_prewarm
+from shared_state import get_shared_state
+from rerun_profiler import profile_section, render_profiler_panel
 
 # ==============================================================================
 # 0. 基本設定
@@ -20,17 +36,34 @@ load_dotenv()
 ACCENT_COLOR = "#00C8FF"
 MAX_CHAT_LIMIT = 5
 MAX_IMAGE_LIMIT = 2
-
-BASE_DIR = Path(__file__).parent
-PARTICLE_IMG_DARK = "ro.png"  
-PARTICLE_IMG_LIGHT = "ba.png"  
+MAX_DAILY_TOKENS = 30000   # 生徒1人あたり1日のトークン上限（入力＋出力）
+STOPPED_SUFFIX = "\n\n*（途中で停止しました）*"  # 停止した応答の末尾に付ける印
+FAILED_SUFFIX = "\n\n*（エラーのため途中までです）*"  # 途中でエラーになった応答の末尾に付ける印
+MAX_CONTEXT_MESSAGES = 20  # OpenAI に送る直近の会話数
+IMAGE_JOB_POLL_SECONDS = 1.0  # 生成中の画像ジョブの確認間隔（そのメッセージだけ再描画）
+
+# 粒子画像は build_assets.py で assets_src/ から生成したもの
+PARTICLE_IMG_DARK = "assets/ro.png"  
+PARTICLE_IMG_LIGHT = "assets/ba.png"  
 WALLPAPER_IMG_DARK = None
 WALLPAPER_IMG_LIGHT = None
 
 IMG_PASSWORD = st.secrets.get("IMG_PASSWORD", None)
 
+# Sheets 認証・ロスター読み込み・OpenAI 接続をバックグラウンドで先に済ませる
+start_prewarm()
 
-security_gate()  # ここで st.session_state.logged_in, student_id, license_type, usage_count などが入る想定
+# REDIS_URL を設定した構成で共有ストアに繋がらないときは受け付けない
+# （レプリカごとに回数・ログインがずれるため。次の再読み込みで接続をやり直す）
+try:
+    get_shared_state()
+except RuntimeError:
+    st.error("⚠️ サーバの共有ストアに接続できません。しばらくしてから再読み込みしてください。")
+    st.stop()
+
+# 各区間の所要時間は rerun_profiler.py で計測できる（既定は off）
+with profile_section("security_gate"):
+    security_gate()  # ここで st.session_state.logged_in, student_id, license_type, usage_count などが入る想定
 
 # ==============================================================================
 # セッション初期化
@@ -51,31 +84,54 @@ if "img_unlocked" not in st.session_state:
 license_type = st.session_state.license_type  # "student" or "admin"
 student_id = st.session_state.student_id
 
-# OpenAI クライアント準備
-try:
-    from openai import OpenAI
+# 先生は全員 "ADMIN" なので、画像の枠は台帳上もセッションごとに分ける（以前と同じく1セッション単位）
+if license_type == "admin":
+    if "admin_quota_id" not in st.session_state:
+        st.session_state.admin_quota_id = f"ADMIN:{secrets.token_hex(6)}"
+    image_quota_id = st.session_state.admin_quota_id
+else:
+    image_quota_id = student_id
+
+# 利用回数はプロセス共有の台帳から取る（複数タブ・再ログインでも同じ枠）
+quota_ledger = get_quota_ledger()
+with profile_section("quota_usage"):
+    st.session_state.usage_count = quota_ledger.usage(student_id, "chat")
+    st.session_state.image_count = quota_ledger.usage(image_quota_id, "image")
+    st.session_state.token_count = quota_ledger.usage(student_id, "tokens")
+
+# 履歴は生徒ごとにローカル保存。ログイン後の最初の実行で読み込む
+# 先生は全員 "ADMIN" でログインするので、履歴は保存も読み込みもしない（このセッションの間だけ）
+history_store = get_history_store()
+if st.session_state.get("history_owner") != student_id:
+    if license_type == "admin":
+        st.session_state.messages = []
+    else:
+        with profile_section("history_load"):
+            st.session_state.messages = history_store.load(student_id)
+    st.session_state.history_saved = len(st.session_state.messages)
+    # 読み込んだ過去の履歴は表示だけ。OpenAI に送る文脈はこのセッションの分から
+    st.session_state.context_start = len(st.session_state.messages)
+    st.session_state.history_window = HISTORY_PAGE_SIZE
+    st.session_state.history_owner = student_id
 
-    api_key = st.secrets.get("OPENAI_API_KEY")
-    has_openai_lib = True
-except ImportError:
-    has_openai_lib = False
-    api_key = None
 
+def persist_history():
+    """未保存の確定メッセージを追記する（生成中の画像ジョブより後ろは次回に回す）"""
+    messages = st.session_state.messages
+    start = st.session_state.history_saved
+    end = start
+    while end < len(messages) and messages[end].get("type") != "image_job":
+        end += 1
+    if end > start:
+        if license_type != "admin":
+            history_store.append(student_id, messages[start:end])
+        st.session_state.history_saved = end
 
-# ==============================================================================
-# 3. 画像読み込み
-# ==============================================================================
-def get_image_base64(filename: str) -> str:
 
-    if not filename:
-        return ""
-    full_path = BASE_DIR / filename
-    if full_path.exists():
-        with open(full_path, "rb") as f:
-            encoded = base64.b64encode(f.read()).decode("utf-8")
-        return f"data:image/png;base64,{encoded}"
-    print(f"[WARN] image not found: {full_path}")
-    return ""
+persist_history()
+
+# OpenAI クライアント準備（プロセス共有・ウォームアップ済み）
+client = get_openai_client()
 
 
 # ==============================================================================
@@ -85,7 +141,7 @@ def toggle_mode():
     st.session_state.dark_mode = not st.session_state.dark_mode
 
 
-with st.sidebar:
+with profile_section("sidebar"), st.sidebar:
     st.title("　ㅇ‐ㅇ?　")
     st.markdown(f"**ID:** `{student_id}`")
 
@@ -99,6 +155,7 @@ with st.sidebar:
         st.metric("Remaining Chats", "∞")
     else:
         st.metric("Remaining Chats", f"{remaining} / {MAX_CHAT_LIMIT}")
+        st.metric("Tokens Today", f"{st.session_state.token_count:,} / {MAX_DAILY_TOKENS:,}")
 
     st.toggle(
         "Dark Mode",
@@ -152,310 +209,42 @@ with st.sidebar:
 
     st.divider()
 
+    # 先生用：ログシートの transcript ID から全文を表示
+    if license_type == "admin":
+        with st.expander("Transcript"):
+            transcript_id = st.text_input("Transcript ID", key="transcript_lookup")
+            if transcript_id:
+                record = get_transcript_store().get(transcript_id)
+                if record:
+                    st.json(record)
+                else:
+                    st.warning("該当するトランスクリプトがありません。")
+        render_export_panel()
+        render_profiler_panel()
+        st.divider()
+
     if st.button("Logout"):
-        st.session_state.messages = []
-        st.session_state.logged_in = False
-        st.session_state.student_id = None
-        st.session_state.license_type = "student"
+        logout()
         st.rerun()
 
 
 # ==============================================================================
-# 5. CSS & HTML (Variables definition first!)
+# 5. CSS & HTML
 # ==============================================================================
-# ★ここで変数を定義します（st.markdownより前に置く必要があります）
-if st.session_state.dark_mode:
-    particle_src = get_image_base64(PARTICLE_IMG_DARK)
-    wallpaper_src = get_image_base64(WALLPAPER_IMG_DARK) if WALLPAPER_IMG_DARK else ""
-    bg_color = "#000000"
-    p_color_main = "#ffffff"
-    p_color_sub = "#444444"
-    css_text_color = "#eeeeee"
-    css_bg_rgba = "rgba(0, 0, 0, 0.6)"
-    css_input_bg = "rgba(10, 10, 10, 0.9)"
-    css_border_color = "rgba(255, 255, 255, 0.1)"
-    css_mask_color = "#000000"
-else:
-    particle_src = get_image_base64(PARTICLE_IMG_LIGHT)
-    wallpaper_src = get_image_base64(WALLPAPER_IMG_LIGHT) if WALLPAPER_IMG_LIGHT else ""
-    bg_color = "#ffffff"
-    p_color_main = "#000000"
-    p_color_sub = "#cccccc"
-    css_text_color = "#333333"
-    css_bg_rgba = "rgba(255, 255, 255, 0.7)"
-    css_input_bg = "rgba(245, 245, 245, 0.95)"
-    css_border_color = "rgba(0, 0, 0, 0.1)"
-    css_mask_color = "#ffffff"
-
-if wallpaper_src:
-    bg_style = (
-        f"background-image: url('{wallpaper_src}');"
-        "background-size: cover; background-position: center;"
+# 両テーマ分を組み立て済みの CSS / 背景を使う（内容が毎回同じなので再描画されない）
+# テーマの切替は目印要素のクラスだけを差し替え、ブラウザ側で反映する
+# スタイル本体は背景コンポーネントが親ページに入れる（背景がある間だけ有効）
+with profile_section("background_html"):
+    # get_image_base64（粒子画像の読み込み）はこの中で呼ばれる
+    components.html(
+        build_background_html(
+            ACCENT_COLOR,
+            PARTICLE_IMG_LIGHT, PARTICLE_IMG_DARK, WALLPAPER_IMG_LIGHT, WALLPAPER_IMG_DARK,
+        ),
+        height=0,
     )
-else:
-    bg_style = f"background-color: {bg_color};"
-
-# --- 背景アニメーション HTML ---
-html_template = """
-<!DOCTYPE html>
-<html lang="ja">
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body { margin: 0; overflow: hidden; width: 100vw; height: 100vh; __BG_STYLE__ transition: background 0.5s ease; }
-        canvas { display: block; width: 100%; height: 100%; }
-    </style>
-</head>
-<body>
-    <canvas id="canvas"></canvas>
-    <script>
-        const CONFIG = {
-            particleSize: 5.5,
-            particleMargin: 1,
-            repulsionRadius: 80,
-            repulsionForce: 2.5,
-            friction: 0.12,
-            returnSpeed: 0.015,
-            samplingStep: 4,
-            maxDisplayRatio: 0.7
-        };
-        let particles = [], mouse = { x: -1000, y: -1000 };
-        const canvas = document.getElementById('canvas'), ctx = canvas.getContext('2d');
-        const imageSrc = "__PARTICLE_SRC__";
-        class Particle {
-            constructor(x, y, colorType) {
-                this.originalX = x; this.originalY = y;
-                this.x = x; this.y = y;
-                this.vx = 0; this.vy = 0;
-                this.baseColor = colorType === 'main' ? '__P_COLOR_1__' : '__P_COLOR_2__';
-            }
-            update() {
-                const dx = this.x - mouse.x, dy = this.y - mouse.y;
-                const dist = Math.sqrt(dx*dx + dy*dy);
-                if (dist < CONFIG.repulsionRadius) {
-                    const angle = Math.atan2(dy, dx);
-                    const force = (CONFIG.repulsionRadius - dist) / CONFIG.repulsionRadius;
-                    const rep = force * force * CONFIG.repulsionForce;
-                    this.vx += Math.cos(angle) * rep;
-                    this.vy += Math.sin(angle) * rep;
-                }
-                this.vx += (this.originalX - this.x) * CONFIG.returnSpeed;
-                this.vy += (this.originalY - this.y) * CONFIG.returnSpeed;
-                this.vx *= (1 - CONFIG.friction);
-                this.vy *= (1 - CONFIG.friction);
-                this.x += this.vx;
-                this.y += this.vy;
-            }
-            draw() {
-                ctx.fillStyle = this.baseColor;
-                ctx.beginPath();
-                ctx.arc(this.x, this.y, CONFIG.particleSize/2, 0, Math.PI*2);
-                ctx.fill();
-            }
-        }
-        function init() {
-            window.addEventListener('resize', resize);
-            window.addEventListener('mousemove', e => {
-                mouse.x = e.clientX; mouse.y = e.clientY;
-            });
-            window.addEventListener('touchmove', e => {
-                mouse.x = e.touches[0].clientX; mouse.y = e.touches[0].clientY;
-            });
-            if (imageSrc) {
-                const img = new Image();
-                img.src = imageSrc;
-                img.onload = () => { resize(); generateParticles(img); };
-            }
-        }
-        function resize() {
-            canvas.width = window.innerWidth;
-            canvas.height = window.innerHeight;
-        }
-        function generateParticles(img) {
-            particles = [];
-            const temp = document.createElement('canvas');
-            const tCtx = temp.getContext('2d');
-            const tW = window.innerWidth * CONFIG.maxDisplayRatio;
-            const tH = window.innerHeight * CONFIG.maxDisplayRatio;
-            const scale = Math.min(tW / img.width, tH / img.height);
-            const w = Math.floor(img.width * scale);
-            const h = Math.floor(img.height * scale);
-            temp.width = w; temp.height = h;
-            tCtx.drawImage(img, 0, 0, w, h);
-            const data = tCtx.getImageData(0, 0, w, h).data;
-            const offX = (window.innerWidth - w) / 2;
-            const offY = (window.innerHeight - h) / 2;
-            for (let y = 0; y < h; y += CONFIG.samplingStep) {
-                for (let x = 0; x < w; x += CONFIG.samplingStep) {
-                    const i = (y * w + x) * 4;
-                    if (data[i + 3] > 128) {
-                        const b = (data[i] + data[i+1] + data[i+2]) / 3;
-                        particles.push(new Particle(x+offX, y+offY, b > 128 ? 'main' : 'sub'));
-                    }
-                }
-            }
-            animate();
-        }
-        function animate() {
-            ctx.clearRect(0, 0, canvas.width, canvas.height);
-            particles.forEach(p => { p.update(); p.draw(); });
-            requestAnimationFrame(animate);
-        }
-        init();
-    </script>
-</body>
-</html>
-"""
-
-final_html = (
-    html_template
-    .replace("__PARTICLE_SRC__", particle_src)
-    .replace("__BG_STYLE__", bg_style)
-    .replace("__P_COLOR_1__", p_color_main)
-    .replace("__P_COLOR_2__", p_color_sub)
-)
-components.html(final_html, height=0)
-
-# --- スタイル定義 (変数定義後に実行) ---
-st.markdown(
-    f"""
-<style>
-    /* iframe（背景）の設定 */
-    iframe[data-testid="stIFrame"] {{
-        position: fixed !important;
-        top: 0 !important;
-        left: 0 !important;
-        width: 100vw !important;
-        height: 100vh !important;
-        z-index: 0 !important;
-        border: none !important;
-        pointer-events: auto !important; /* ★ここを auto に戻しました（粒子が動くようになります） */
-    }}
-
-    /* 全体の背景透明化 */
-    .stApp {{ background: transparent !important; }}
-    header, header > div {{ background: transparent !important; }}
-
-    /* サイドバー開閉ボタン */
-    button[data-testid="stSidebarCollapsedControl"] {{
-        color: {css_text_color} !important;
-        background-color: {css_bg_rgba} !important;
-        border-radius: 5px;
-        margin-top: 10px; margin-left: 10px;
-        z-index: 1001 !important;
-    }}
-
-    /* サイドバー本体 */
-    section[data-testid="stSidebar"] {{
-        background-color: {css_input_bg} !important;
-        border-right: 1px solid {css_border_color};
-    }}
-    section[data-testid="stSidebar"] h1,
-    section[data-testid="stSidebar"] label,
-    section[data-testid="stSidebar"] span {{
-        color: {css_text_color} !important;
-    }}
-
-    /* ヘッダー部分のマスク */
-    .title-mask {{
-        position: fixed; top: 0; left: 0;
-        width: 100%; height: 100px; 
-        background: {css_mask_color};
-        background: linear-gradient(to bottom, {css_mask_color} 60%, transparent);
-        z-index: 999; 
-        pointer-events: none;
-    }}
-
-    /* タイトル文字 */
-    h1 {{
-        position: fixed !important;
-        top: 15px; left: 60px;
-        margin: 0 !important;
-        font-family: 'Arial', sans-serif;
-        font-weight: 900; font-size: 1.8rem !important;
-        letter-spacing: 2px;
-        color: {css_text_color} !important;
-        text-shadow: 0 0 10px rgba(128,128,128,0.3);
-        z-index: 1000; pointer-events: none;
-    }}
-    
-    /* 入力欄の背景 */
-    div[data-testid="stBottom"] {{
-        background: linear-gradient(
-            to top,
-            {css_mask_color} 40%, 
-            transparent 100%
-        ) !important;
-        z-index: 998;
-        padding-bottom: 0px !important;
-    }}
-
-    div[data-testid="stBottom"] > div {{
-        background: transparent !important;
-    }}
-    
-    div[data-testid="stChatInput"] {{
-        width: 60% !important;
-        margin: 0 auto !important;
-        position: fixed !important; 
-        bottom: 15px !important; /* 0pxにすると本当にベタ付けになります。10pxくらいが綺麗です */
-        left: 50% !important;
-        transform: translateX(-50%) !important; /* 真ん中に寄せるため */
-        
-        z-index: 1000;
-        padding-bottom: 0px !important;
-    }}
-    
-    .stTextInput input, .stTextInput textarea {{
-        background-color: {css_input_bg} !important;
-        color: {css_text_color} !important;
-        border: 1px solid {css_border_color} !important;
-        border-radius: 12px !important;
-    }}
-    
-    /* ★メインコンテナのレイアウト調整 */
-    .block-container {{
-        padding-top: 120px !important;
-        padding-bottom: 100px !important; /* ★ここを増やしました（一番下のメッセージが上がります） */
-        max-width: 1000px !important;
-        pointer-events: none;
-    }}
-    
-    /* チャットメッセージ */
-    div[data-testid="stChatMessage"] {{
-        background-color: {css_bg_rgba} !important;
-        border: 1px solid {css_border_color};
-        border-left: 3px solid {ACCENT_COLOR} !important;
-        border-radius: 4px;
-        backdrop-filter: blur(5px);
-        width: 90%; margin: 0 auto;
-        position: relative; z-index: 997;
-        pointer-events: none !important;
-    }}
-    div[data-testid="stChatMessage"] div,
-    div[data-testid="stChatMessage"] p,
-    div[data-testid="stChatMessage"] code {{
-        color: {css_text_color} !important;
-        pointer-events: auto !important;
-    }}
-    .katex {{ color: {css_text_color} !important; pointer-events: auto !important; }}
-    .katex-display {{ pointer-events: auto !important; }}
-    
-    /* ステータス表示 */
-    .prts-status {{
-        position: fixed !important;
-        bottom: 5px; right: 10px;
-        font-family: 'Courier New', monospace;
-        color: {css_text_color} !important;
-        z-index: 1000;
-        pointer-events: none;
-        text-align: right; font-size: 0.8em;
-        opacity: 0.8;
-    }}
-</style>
-""",
-    unsafe_allow_html=True,
-)
+with profile_section("theme_marker"):
+    st.markdown(theme_marker_html(st.session_state.dark_mode), unsafe_allow_html=True)
 # ==============================================================================
 # 6. チャットUI
 # ==============================================================================
@@ -475,12 +264,109 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        if msg.get("type") == "image":
-            st.image(msg["content"])
-        else:
-            st.markdown(msg["content"])
+def resolve_image_job(msg: dict) -> bool:
+    """
+    画像生成ジョブのメッセージを最新の状態にする。まだ生成中なら True。
+    完了したら通常の画像メッセージ、失敗したらエラーメッセージに置き換える。
+    """
+    job = get_image_job_runner().get(msg["job_id"])
+    if job and job["status"] in ("queued", "running"):
+        return True
+    if job and job["status"] == "done":
+        msg.update({"type": "image", "content": job["result"]})
+    else:
+        # 失敗（またはサーバ再起動で消えた）分は予約を返却する
+        if msg.get("quota_day"):
+            quota_ledger.release(image_quota_id, "image", msg["quota_day"])
+        msg.update({"type": "error", "content": f"Error: image generation failed for '{msg['prompt']}'"})
+    return False
+
+
+def resolve_pending_image_jobs() -> list:
+    """
+    未保存の範囲にある画像ジョブをすべて確認し、まだ生成中のものを返す。
+    表示範囲の外に出たジョブも確認する（止まったままだと後ろの履歴が保存されず、
+    失敗したジョブの枠も返却されないため）。
+    """
+    return [
+        m for m in st.session_state.messages[st.session_state.history_saved:]
+        if m.get("type") == "image_job" and resolve_image_job(m)
+    ]
+
+
+@st.fragment(run_every=IMAGE_JOB_POLL_SECONDS)
+def poll_hidden_image_jobs(msgs: list):
+    """表示範囲の外で生成中のジョブを見張り、どれかが終わったら全体を rerun して保存する"""
+    if not all([resolve_image_job(m) for m in msgs]):
+        st.rerun()
+
+
+@st.fragment(run_every=IMAGE_JOB_POLL_SECONDS)
+def render_image_job(msg: dict):
+    """
+    生成中の画像ジョブの表示。この部分だけを定期的に再実行して進み具合を確認する
+    （認証・サイドバー・CSS などスクリプト全体は再実行しない）。
+    完了・失敗したら1回だけ全体を rerun し、通常のメッセージとして描画・保存する。
+    """
+    if resolve_image_job(msg):
+        st.markdown(f"Generating visual data for '{msg['prompt']}'...")
+    else:
+        st.rerun()
+
+
+# 描画は直近 history_window 件だけ（長い履歴でも再実行のコストを一定に保つ）
+hidden_count = len(st.session_state.messages) - st.session_state.history_window
+if hidden_count > 0:
+    if st.button(f"▲ 以前のメッセージを表示（残り {hidden_count} 件）"):
+        st.session_state.history_window += HISTORY_PAGE_SIZE
+        st.rerun()
+
+with profile_section("history_render"):
+    pending_jobs = resolve_pending_image_jobs()
+    visible = st.session_state.messages[-st.session_state.history_window:]
+    visible_ids = {id(m) for m in visible}
+    hidden_jobs = [m for m in pending_jobs if id(m) not in visible_ids]
+    if hidden_jobs:
+        poll_hidden_image_jobs(hidden_jobs)
+    for msg in visible:
+        with st.chat_message(msg["role"]):
+            if msg.get("type") == "image_job":
+                render_image_job(msg)
+            elif msg.get("type") == "image" and msg.get("image_path"):
+                st.image(load_history_image(msg["content"]))
+            elif msg.get("type") == "image":
+                st.image(msg["content"])
+            else:
+                st.markdown(msg["content"])
+
+# 完了した画像ジョブ（とその後ろのメッセージ）をすぐ保存する
+persist_history()
+
+def record_partial_answer(partial, suffix, route, messages_payload, token_day, token_reserved):
+    """
+    生成が途中で終わったとき（停止・エラー）、そこまでの回答を履歴とログに残し、トークンを計上する。
+    usage は最後のチャンクにしか付かないので、トークン数は送信分＋受信済みの文字数から概算する。
+    """
+    content = partial + suffix
+    st.session_state.messages.append({"role": "assistant", "content": content})
+    persist_history()
+
+    usage = {
+        "prompt_tokens": estimate_prompt_tokens(messages_payload),
+        "completion_tokens": estimate_completion_tokens(partial),
+        "model": route.get("used_model", route["model"]),
+    }
+    if token_day:
+        quota_ledger.settle(
+            student_id, "tokens", token_day, token_reserved,
+            usage["prompt_tokens"] + usage["completion_tokens"],
+        )
+    if license_type == "student" and student_id:
+        save_log_to_sheet(
+            student_id, prompt, content,
+            context=messages_payload, usage=usage, truncated=True,
+        )
+
 
 # ===== ユーザー入力 =====
 prompt = st.chat_input("Command...")
@@ -513,64 +399,61 @@ if prompt:
         ai_response_content = ""
         should_rerun = True
 
-        if is_gen_img_req and st.session_state.image_count >= MAX_IMAGE_LIMIT:
+        # OpenAI を呼ぶ前に台帳で「チェック＋予約」を一度に行う（複数タブの同時送信対策）
+        if is_gen_img_req:
+            quota_kind, quota_limit = "image", MAX_IMAGE_LIMIT
+        elif license_type != "admin":
+            quota_kind, quota_limit = "chat", MAX_CHAT_LIMIT
+        else:
+            quota_kind, quota_limit = None, None
+        quota_day = None
+        token_day, token_reserved = None, 0
+        answer_recorded = False  # 途中までの回答を計上済み（予約を返却しない）
+        quota_owner = image_quota_id if quota_kind == "image" else student_id
+        if quota_kind:
+            quota_day = quota_ledger.try_reserve(quota_owner, quota_kind, quota_limit)
+
+        if quota_kind == "image" and quota_day is None:
             error_msg = "⚠️ Image generation limit reached."
             message_placeholder.error(error_msg)
             st.session_state.messages.append(
-                {"role": "assistant", "content": error_msg}
+                {"role": "assistant", "content": error_msg, "type": "error"}
             )
             ai_response_content = error_msg
             should_rerun = False  
 
-        elif (
-            not is_gen_img_req
-            and license_type != "admin"
-            and st.session_state.get("usage_count", 0) >= MAX_CHAT_LIMIT
-        ):
+        elif quota_kind == "chat" and quota_day is None:
             error_msg = "⚠️ Daily chat limit reached. (本日の制限回数を超えました)"
             message_placeholder.error(error_msg)
             st.session_state.messages.append(
-                {"role": "assistant", "content": error_msg}
+                {"role": "assistant", "content": error_msg, "type": "error"}
             )
             ai_response_content = error_msg
             should_rerun = False
 
-        elif api_key and has_openai_lib:
+        elif client is not None:
             try:
-                client = OpenAI(api_key=api_key)
-
-                
                 if is_gen_img_req:
                     clean_prompt = prompt.strip()
 
+                    # 生成はバックグラウンドのワーカーに任せ、ここでは job_id だけ持つ
+                    # （再実行しても結果は失われない。同じプロンプトは1回の生成を共有）
+                    with profile_section("image_submit"):
+                        job_id, _ = get_image_job_runner().submit(client, clean_prompt)
                     message_placeholder.markdown(
                         f"Generating visual data for '{clean_prompt}'..."
                     )
-
-                
-                    img_response = client.images.generate(
-                        model="gpt-image-1",
-                        prompt=f"Arknights style, anime art, {clean_prompt}",
-                        size="1024x1024",
-                        n=1,
-                    )
-
-                   
-                    image_url = img_response.data[0].url
-
-                    message_placeholder.empty()
-                    st.image(image_url, caption=f"Generated: {clean_prompt}")
-
-               
                     st.session_state.messages.append(
                         {
                             "role": "assistant",
-                            "content": image_url,
-                            "type": "image",
+                            "content": "",
+                            "type": "image_job",
+                            "job_id": job_id,
+                            "prompt": clean_prompt,
+                            "quota_day": quota_day,
                         }
                     )
-                    st.session_state.image_count += 1
-                    ai_response_content = "<Image Generated>"
+                    ai_response_content = "<Image Job Submitted>"
 
 
                 # ===== 通常チャットモード =====
@@ -590,8 +473,12 @@ if prompt:
 
                 
                     messages_payload = [{"role": "system", "content": system_prompt}]
-                    for m in st.session_state.messages:
-                        if m.get("type") != "image":
+                    # 過去のセッションの履歴（前日のエラー表示なども含む）は送らず、
+                    # このセッションの直近の分だけを文脈にする
+                    session_messages = st.session_state.messages[st.session_state.context_start:]
+                    for m in session_messages[-MAX_CONTEXT_MESSAGES:]:
+                        # 上限・エラーの表示（type="error"）はモデルに送らない
+                        if m.get("type") not in ("image", "image_job", "error"):
                             messages_payload.append(
                                 {"role": m["role"], "content": m["content"]}
                             )
@@ -619,50 +506,132 @@ if prompt:
                             )
 
                     
-                    stream = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=messages_payload,
-                        stream=True,
+                    # モデル・max_tokens はルールと直近の応答速度から決める
+                    route = choose_route(
+                        prompt, current_image_bytes is not None, license_type
                     )
-                    for chunk in stream:
-                        if chunk.choices[0].delta.content is not None:
-                            full_response += chunk.choices[0].delta.content
-                            message_placeholder.markdown(full_response + "▌")
+
+                    # トークン枠は送信前に見積もり（入力＋出力上限）で予約し、後で実数に合わせる
+                    if license_type != "admin":
+                        token_reserved = (
+                            estimate_prompt_tokens(messages_payload) + route["max_tokens"]
+                        )
+                        token_day = quota_ledger.try_reserve(
+                            student_id, "tokens", MAX_DAILY_TOKENS, amount=token_reserved
+                        )
+                        if token_day is None:
+                            raise QuotaExceeded("tokens")
+
+                    # 生成中だけ停止ボタンを出す。押す（または別の操作をする）と、Streamlit は
+                    # 次の描画呼び出しで rerun 用の制御例外（Exception ではない）を投げる
+                    stop_slot = st.empty()
+                    stop_slot.button("■ Stop", key="stop_stream")
+                    chunks = stream_chat(client, route, messages_payload)
+                    try:
+                        with profile_section("openai_stream"):
+                            for delta in chunks:
+                                full_response += delta
+                                message_placeholder.markdown(full_response + "▌")
+                    except BaseException as e:
+                        # ジェネレータを閉じると stream_chat 側で HTTP ストリームを切断し、
+                        # それ以上の生成（と課金）を止める
+                        chunks.close()
+                        if not isinstance(e, Exception):
+                            record_partial_answer(
+                                full_response, STOPPED_SUFFIX, route, messages_payload,
+                                token_day, token_reserved,
+                            )
+                        elif full_response:
+                            # 途中まで生成された分は課金済みなので、停止と同じく計上する
+                            record_partial_answer(
+                                full_response, FAILED_SUFFIX, route, messages_payload,
+                                token_day, token_reserved,
+                            )
+                            answer_recorded = True
+                        raise
+                    finally:
+                        stop_slot.empty()
                     message_placeholder.markdown(full_response)
                     st.session_state.messages.append(
                         {"role": "assistant", "content": full_response}
                     )
 
+                    usage = route.get("usage")
+                    if token_day:
+                        # usage が返らなかったときは見積もりのまま計上する
+                        actual = (
+                            usage["prompt_tokens"] + usage["completion_tokens"]
+                            if usage
+                            else token_reserved
+                        )
+                        quota_ledger.settle(
+                            student_id, "tokens", token_day, token_reserved, actual
+                        )
+
                     # ログ
-                    if license_type == "student":
-                        st.session_state["usage_count"] = (
-                            st.session_state.get("usage_count", 0) + 1
+                    if license_type == "student" and student_id:
+                        save_log_to_sheet(
+                            student_id, prompt, full_response,
+                            context=messages_payload, usage=usage,
                         )
-                        if student_id:
-                            save_log_to_sheet(student_id, prompt, full_response)
 
                     ai_response_content = full_response
 
+            except QuotaExceeded:
+                if quota_day:
+                    quota_ledger.release(quota_owner, quota_kind, quota_day)
+                error_msg = "⚠️ Daily token limit reached. (本日の利用量の上限に達しました)"
+                message_placeholder.error(error_msg)
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": error_msg, "type": "error"}
+                )
+                ai_response_content = error_msg
+                should_rerun = False
+
+            except ImageJobsBusy:
+                if quota_day:
+                    quota_ledger.release(quota_owner, quota_kind, quota_day)
+                error_msg = "⚠️ 画像生成が混み合っています。少し待ってからもう一度どうぞ。"
+                message_placeholder.error(error_msg)
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": error_msg, "type": "error"}
+                )
+                ai_response_content = error_msg
+                should_rerun = False
+
             except Exception as e:
+                # 失敗した分の予約は返却する（途中まで生成した回答は計上済みなので残す）
+                if quota_day and not answer_recorded:
+                    quota_ledger.release(quota_owner, quota_kind, quota_day)
+                if token_day and not answer_recorded:
+                    quota_ledger.release(student_id, "tokens", token_day, token_reserved)
                 # OpenAI エラー時もメッセージとして履歴に残す
                 error_msg = f"Error: {str(e)}"
-                message_placeholder.error(error_msg)
+                if answer_recorded:
+                    message_placeholder.markdown(full_response + FAILED_SUFFIX)
+                    st.error(error_msg)
+                else:
+                    message_placeholder.error(error_msg)
                 st.session_state.messages.append(
-                    {"role": "assistant", "content": error_msg}
+                    {"role": "assistant", "content": error_msg, "type": "error"}
                 )
                 ai_response_content = error_msg
                 should_rerun = False  # エラー時は rerun しない
 
         # ③ OpenAI が使えないとき
         else:
+            if quota_day:
+                quota_ledger.release(quota_owner, quota_kind, quota_day)
             dummy_response = "PRTS Offline (API Key Missing)."
             message_placeholder.markdown(dummy_response)
             st.session_state.messages.append(
-                {"role": "assistant", "content": dummy_response}
+                {"role": "assistant", "content": dummy_response, "type": "error"}
             )
             ai_response_content = dummy_response
             should_rerun = False  # これも rerun しなくてよい
 
+    persist_history()
+
     # 1回ごとに、正常なときだけ rerun する
     if should_rerun:
         time.sleep(0.5)
@@ -1,11 +1,18 @@
 # auth_gate.py
+import datetime
+import time
 import streamlit as st
+import extra_streamlit_components as stx
 from sheets_utils import (
     find_student_record,
     update_student_pin_and_login,
     update_last_login_only,
-    get_initial_usage_count,
+    is_sheets_degraded,
 )
+from quota_ledger import get_quota_ledger
+from session_store import SESSION_COOKIE_NAME, get_session_store
+
+SESSION_TOUCH_INTERVAL = 60  # 共有ストアへの書き込みを減らすため、延長は1分に1回まで
 
 
 def _init_session_state():
@@ -14,6 +21,10 @@ def _init_session_state():
         "usage_count": 0,
         "logged_in": False,
         "license_type": "student",  # "student" or "admin"
+        "session_token": None,
+        "pending_cookie": None,       # 次の実行で Cookie に書くトークン
+        "pending_cookie_delete": False,
+        "session_touched_at": 0.0,    # 最後にサーバ側セッションを延長した時刻
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -48,6 +59,58 @@ def validate_pin_format(pin: str):
     return len(p) == 4 and p.isdigit()
 
 
+def _get_cookie_manager():
+    # CookieManager はコンポーネントなので 1回の実行で1度だけ生成する
+    return stx.CookieManager(key="tomato_cookie_manager")
+
+
+def _login(student_id: str, license_type: str):
+    """ログイン状態をセットし、再接続用のセッショントークンを発行する"""
+    st.session_state.student_id = student_id
+    st.session_state.logged_in = True
+    st.session_state.license_type = license_type
+    token, expires = get_session_store().create(student_id, license_type)
+    st.session_state.session_token = token
+    # st.rerun() 直後だと Cookie 書き込みが反映されないので次の実行で書く
+    st.session_state.pending_cookie = (token, expires)
+
+
+def _restore_from_cookie(cookie_manager) -> bool:
+    """
+    Cookie のトークンからログイン状態を復元する（Sheets へのアクセスなし）。
+    復元できたら True。
+    """
+    token = cookie_manager.get(SESSION_COOKIE_NAME)
+    if not token:
+        return False
+    rec = get_session_store().resolve(token)
+    if not rec:
+        return False
+    st.session_state.student_id = rec["student_id"]
+    st.session_state.logged_in = True
+    st.session_state.license_type = rec["license_type"]
+    st.session_state.session_token = token
+    if rec["license_type"] == "admin":
+        st.session_state.usage_count = 0
+    else:
+        st.session_state.usage_count = get_quota_ledger().usage(rec["student_id"], "chat")
+    return True
+
+
+def logout():
+    """ログアウト：サーバ側トークンを失効させ、Cookie も削除する"""
+    if st.session_state.get("session_token"):
+        get_session_store().revoke(st.session_state.session_token)
+    st.session_state.session_token = None
+    st.session_state.pending_cookie = None
+    st.session_state.pending_cookie_delete = True
+    st.session_state.messages = []
+    st.session_state.history_owner = None  # 次のログインで履歴を読み直す
+    st.session_state.logged_in = False
+    st.session_state.student_id = None
+    st.session_state.license_type = "student"
+
+
 def security_gate():
     """
     ログイン画面の表示と処理。
@@ -56,11 +119,36 @@ def security_gate():
       （初回は PIN 未登録 → サインイン扱い）
     """
     _init_session_state()
+    cookie_manager = _get_cookie_manager()
 
-    # すでにログイン済みなら何もしない
+    # すでにログイン済みなら何もしない（発行済みトークンの Cookie 書き込みだけ行う）
     if st.session_state.logged_in:
+        if st.session_state.pending_cookie:
+            token, expires = st.session_state.pending_cookie
+            cookie_manager.set(
+                SESSION_COOKIE_NAME,
+                token,
+                expires_at=datetime.datetime.fromtimestamp(expires),
+                key="set_session_cookie",
+            )
+            st.session_state.pending_cookie = None
+        # 操作がある間はサーバ側セッションのアイドル期限を延ばす
+        now = time.time()
+        if st.session_state.session_token and now - st.session_state.session_touched_at > SESSION_TOUCH_INTERVAL:
+            get_session_store().touch(st.session_state.session_token)
+            st.session_state.session_touched_at = now
         return
 
+    if st.session_state.pending_cookie_delete:
+        st.session_state.pending_cookie_delete = False
+        try:
+            cookie_manager.delete(SESSION_COOKIE_NAME, key="delete_session_cookie")
+        except KeyError:
+            pass
+    # リロード・再接続時は Cookie から復元（ロスター取得・PIN照合・ログ集計を省略）
+    elif _restore_from_cookie(cookie_manager):
+        st.rerun()
+
     st.title("🔒 SECURITY GATE")
     ##st.markdown("Authorized Access Only")
 
@@ -79,13 +167,13 @@ def security_gate():
     st.info(
         "・ID・パスワード・合言葉を入力して接続してください。"
     )
+    if is_sheets_degraded():
+        st.warning("現在スプレッドシートに接続しにくいため、簡易モードで動作しています。")
 
     if st.button("CONNECT"):
         # --- 管理者判定 ---
         if admin_password and access_code == admin_password:
-            st.session_state.student_id = "ADMIN"
-            st.session_state.logged_in = True
-            st.session_state.license_type = "admin"
+            _login("ADMIN", "admin")
             st.session_state.usage_count = 0
             st.success("管理者としてログインしました。")
             st.rerun()
@@ -128,10 +216,8 @@ def security_gate():
                 st.stop()
 
             update_student_pin_and_login(row_idx, pin_input.strip(), is_new=True)
-            st.session_state.student_id = sid
-            st.session_state.logged_in = True
-            st.session_state.license_type = "student"
-            st.session_state.usage_count = get_initial_usage_count(sid)
+            _login(sid, "student")
+            st.session_state.usage_count = get_quota_ledger().usage(sid, "chat")
             st.success(
                 f"サインイン完了: ID {sid} / 本日の利用回数: {st.session_state.usage_count}"
             )
@@ -147,10 +233,8 @@ def security_gate():
                 st.stop()
 
             update_last_login_only(row_idx)
-            st.session_state.student_id = sid
-            st.session_state.logged_in = True
-            st.session_state.license_type = "student"
-            st.session_state.usage_count = get_initial_usage_count(sid)
+            _login(sid, "student")
+            st.session_state.usage_count = get_quota_ledger().usage(sid, "chat")
             st.success(
                 f"ログイン成功: ID {sid} / 本日の利用回数: {st.session_state.usage_count}"
             )
@@ -0,0 +1,137 @@
+# build_assets.py
+"""
+画像アセットの最適化パイプライン（ビルド時に手元で実行する）。
+  python build_assets.py           # assets_src/ → assets/ を生成し manifest.json に記録
+  python build_assets.py --check   # 生成物が最新かだけ確認（CI 用）
+
+背景の粒子画像は「アルファ > 128 か」「明るさ > 128 か」を 4px 間隔で見るだけなので、
+表示サイズに合わせて縮小し、透明・明・暗の3色パレット PNG にしても見た目は変わらない。
+メタデータ（XMP・gamma・dpi など）は書き出さない。
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+APP_DIR = Path(__file__).parent
+SRC_DIR = APP_DIR.parent / "assets_src"
+OUT_DIR = APP_DIR / "assets"
+MANIFEST = OUT_DIR / "manifest.json"
+
+# theme.py の背景アニメーション設定と合わせる
+MAX_DISPLAY_RATIO = 0.7
+SAMPLING_STEP = 4
+REFERENCE_VIEWPORT = 1440  # 想定する最大の画面の短辺（px）
+
+# 粒子画像：長辺 = 表示サイズ上限 / サンプリング間隔（これ以上の解像度は使われない）
+PARTICLE_MAX_SIDE = -(-int(REFERENCE_VIEWPORT * MAX_DISPLAY_RATIO) // SAMPLING_STEP)
+
+ASSETS = {
+    # 出力名: (元ファイル, 種類)
+    "ro.png": ("ro.png", "particle"),
+    "ba.png": ("ba.png", "particle"),
+}
+
+# アプリのフォルダに置いたままでも警告しないファイルサイズの上限
+LARGE_ASSET_BYTES = 256 * 1024
+
+
+def build_particle(src: Path) -> Image.Image:
+    """粒子用：縮小してから、サンプラーが見る2つの閾値で3色に量子化する"""
+    im = Image.open(src).convert("RGBA")
+    im.thumbnail((PARTICLE_MAX_SIDE, PARTICLE_MAX_SIDE), Image.LANCZOS)
+
+    out = Image.new("P", im.size, 0)
+    # パレット: 0=透明, 1=明（main 色になる）, 2=暗（sub 色になる）
+    out.putpalette([0, 0, 0, 255, 255, 255, 0, 0, 0] + [0, 0, 0] * 253)
+    src_px, out_px = im.load(), out.load()
+    for y in range(im.height):
+        for x in range(im.width):
+            r, g, b, a = src_px[x, y]
+            if a > 128:
+                out_px[x, y] = 1 if (r + g + b) / 3 > 128 else 2
+    out.info["transparency"] = 0
+    return out
+
+
+BUILDERS = {"particle": build_particle}
+
+
+def _digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()[:16]
+
+
+def find_unreferenced_assets():
+    """アプリのフォルダにある大きな画像のうち、どのソースからも参照されていないもの"""
+    sources = "\n".join(p.read_text(encoding="utf-8") for p in APP_DIR.glob("*.py"))
+    unreferenced = []
+    for path in APP_DIR.glob("*"):
+        if path.suffix.lower() not in (".png", ".jpg", ".jpeg", ".webp", ".gif"):
+            continue
+        if path.stat().st_size >= LARGE_ASSET_BYTES and not re.search(re.escape(path.name), sources):
+            unreferenced.append(path)
+    return unreferenced
+
+
+def build(check_only: bool = False) -> int:
+    OUT_DIR.mkdir(exist_ok=True)
+    old = json.loads(MANIFEST.read_text()) if MANIFEST.exists() else {}
+    manifest = {"assets": {}, "total_source_bytes": 0, "total_output_bytes": 0}
+    stale = []
+
+    for name, (src_name, kind) in ASSETS.items():
+        src = SRC_DIR / src_name
+        out = OUT_DIR / name
+        digest = _digest(src)
+        prev = old.get("assets", {}).get(name)
+        if prev and prev.get("source_sha256") == digest and out.exists():
+            entry = prev
+        elif check_only:
+            stale.append(name)
+            continue
+        else:
+            image = BUILDERS[kind](src)
+            image.save(out, optimize=True)
+            entry = {
+                "source": f"assets_src/{src_name}",
+                "source_sha256": digest,
+                "source_bytes": src.stat().st_size,
+                "output_bytes": out.stat().st_size,
+                "size": list(image.size),
+            }
+        manifest["assets"][name] = entry
+        manifest["total_source_bytes"] += entry["source_bytes"]
+        manifest["total_output_bytes"] += entry["output_bytes"]
+        saved = entry["source_bytes"] - entry["output_bytes"]
+        print(
+            f"{name:12s} {entry['source_bytes']:>9,d} B -> {entry['output_bytes']:>7,d} B "
+            f"(-{saved / entry['source_bytes']:.0%}) {entry['size'][0]}x{entry['size'][1]}"
+        )
+
+    for path in find_unreferenced_assets():
+        print(f"[WARN] unreferenced large asset in app folder: {path.name} ({path.stat().st_size:,d} B)")
+
+    if stale:
+        print(f"stale assets: {', '.join(stale)} (run python build_assets.py)")
+        return 1
+    if not check_only:
+        total_saved = manifest["total_source_bytes"] - manifest["total_output_bytes"]
+        manifest["total_saved_bytes"] = total_saved
+        MANIFEST.write_text(json.dumps(manifest, indent=2) + "\n")
+        print(f"total saved: {total_saved:,d} B")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--check", action="store_true", help="生成物が最新か確認するだけ")
+    args = parser.parse_args()
+    sys.exit(build(check_only=args.check))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# circuit_breaker.py
+import threading
+import time
+import streamlit as st
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いているため呼び出しを行わなかった"""
+
+
+class CircuitBreaker:
+    """
+    外部 API 用のサーキットブレーカー（全セッション共有）。
+    - closed   : 通常。連続 failure_threshold 回失敗したら open
+    - open     : reset_timeout 秒は即失敗（API を呼ばない）
+    - half_open: 1件だけ試行（probe）を通し、成功なら closed、失敗なら再び open
+    slow_call_seconds を指定すると、成功してもそれより遅い呼び出しは失敗として数える
+    （止まってはいないが遅い状態でも開くように）。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        slow_call_seconds: float = None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        # ロック保持中に呼ぶこと
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """呼び出してよければ True（half_open では probe 1件だけ通す）"""
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                print(f"[breaker:{self.name}] closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    print(f"[breaker:{self.name}] open after {self._failures} failure(s)")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def _release_probe(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def call(self, fn, *args, **kwargs):
+        """
+        fn を呼ぶ。open 中は CircuitOpenError、失敗時は例外をそのまま上げる。
+        成否はここでだけ記録する（実際に API を呼んだ結果だけをブレーカーに伝える）。
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Streamlit の rerun などで中断：成否不明なので probe だけ返す
+            self._release_probe()
+            raise
+        elapsed = time.monotonic() - started
+        if self.slow_call_seconds is not None and elapsed > self.slow_call_seconds:
+            print(f"[breaker:{self.name}] slow call ({elapsed:.1f}s) counted as failure")
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+
+@st.cache_resource
+def get_sheets_breaker() -> CircuitBreaker:
+    return CircuitBreaker("sheets", failure_threshold=3, reset_timeout=30.0, slow_call_seconds=8.0)
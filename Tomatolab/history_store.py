@@ -0,0 +1,86 @@
+# history_store.py
+import json
+import os
+import re
+import secrets
+import threading
+from pathlib import Path
+import streamlit as st
+
+HISTORY_DIR = Path(
+    os.environ.get("TOMATO_HISTORY_DIR", Path(__file__).parent / "state" / "history")
+)
+HISTORY_PAGE_SIZE = 20  # 最初に表示する件数・「さらに表示」で増やす件数
+
+
+def _safe_name(student_id: str) -> str:
+    return re.sub(r"[^0-9A-Za-z_-]", "_", str(student_id))
+
+
+class HistoryStore:
+    """
+    生徒ごとのチャット履歴（ローカル・追記のみ）。
+    {student_id}.jsonl に1メッセージ1行。画像のバイト列は別ファイルに置きパスだけ持つ。
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def _path(self, student_id) -> Path:
+        return self.root / f"{_safe_name(student_id)}.jsonl"
+
+    def _save_image(self, student_id, data: bytes) -> str:
+        img_dir = self.root / _safe_name(student_id)
+        img_dir.mkdir(parents=True, exist_ok=True)
+        path = img_dir / f"{secrets.token_hex(8)}.img"
+        with open(path, "wb") as f:
+            f.write(data)
+        return str(path)
+
+    def append(self, student_id, messages: list):
+        """確定したメッセージを追記する"""
+        if not messages:
+            return
+        lines = []
+        for m in messages:
+            rec = {"role": m["role"], "type": m.get("type"), "content": m.get("content")}
+            if isinstance(rec["content"], (bytes, bytearray)):
+                rec["content"] = self._save_image(student_id, rec["content"])
+                rec["image_path"] = True
+            lines.append(json.dumps(rec, ensure_ascii=False) + "\n")
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(self._path(student_id), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+
+    def load(self, student_id) -> list:
+        path = self._path(student_id)
+        if not path.exists():
+            return []
+        messages = []
+        with self._lock, open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中の行は無視
+                msg = {"role": rec["role"], "content": rec["content"]}
+                if rec.get("type"):
+                    msg["type"] = rec["type"]
+                if rec.get("image_path"):
+                    msg["image_path"] = True
+                messages.append(msg)
+        return messages
+
+
+@st.cache_resource
+def get_history_store() -> HistoryStore:
+    return HistoryStore(HISTORY_DIR)
+
+
+@st.cache_data(max_entries=128)
+def load_history_image(path: str) -> bytes:
+    """保存済み画像は内容が変わらないので読み込み結果をキャッシュする"""
+    with open(path, "rb") as f:
+        return f.read()
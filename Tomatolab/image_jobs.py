@@ -0,0 +1,114 @@
+# image_jobs.py
+import base64
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+
+IMAGE_MODEL = "gpt-image-1"
+IMAGE_SIZE = "1024x1024"
+IMAGE_STYLE_PREFIX = "Arknights style, anime art, "
+
+MAX_IMAGE_WORKERS = 2     # 同時に生成する最大数（全セッション合計）
+MAX_PENDING_JOBS = 8      # 待ち行列も含めた上限。超えたら受け付けない
+JOB_RETENTION_SECONDS = 60 * 60  # 終わったジョブを保持する時間
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+
+
+class ImageJobsBusy(Exception):
+    """待ち行列が一杯で受け付けられない"""
+
+
+def _normalize(prompt: str) -> str:
+    return " ".join(prompt.lower().split())
+
+
+class ImageJobRunner:
+    """
+    画像生成をバックグラウンドのワーカーで実行する（プロセス共有）。
+    - セッションは job_id だけを持ち、再実行のたびに get() で状態を見る
+    - 同じプロンプトの生成が進行中なら、新しく作らずそのジョブを共有する
+    """
+
+    def __init__(self, max_workers: int = MAX_IMAGE_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tomato-image"
+        )
+        self._lock = threading.Lock()
+        self._jobs = {}      # job_id -> {"status", "prompt", "result", "error", "finished_at"}
+        self._inflight = {}  # 正規化したプロンプト -> job_id
+
+    def submit(self, client, prompt: str):
+        """ジョブを登録して (job_id, 共有したか) を返す。満杯なら ImageJobsBusy"""
+        key = _normalize(prompt)
+        with self._lock:
+            self._purge_finished()
+            job_id = self._inflight.get(key)
+            if job_id:
+                return job_id, True
+            pending = sum(1 for j in self._jobs.values() if j["status"] in (QUEUED, RUNNING))
+            if pending >= MAX_PENDING_JOBS:
+                raise ImageJobsBusy()
+            job_id = secrets.token_hex(8)
+            self._jobs[job_id] = {
+                "status": QUEUED,
+                "prompt": prompt,
+                "result": None,
+                "error": None,
+                "finished_at": None,
+            }
+            self._inflight[key] = job_id
+        self._executor.submit(self._run, job_id, key, client, prompt)
+        return job_id, False
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _run(self, job_id, key, client, prompt):
+        self._update(job_id, status=RUNNING)
+        try:
+            response = client.images.generate(
+                model=IMAGE_MODEL,
+                prompt=f"{IMAGE_STYLE_PREFIX}{prompt}",
+                size=IMAGE_SIZE,
+                n=1,
+            )
+            data = response.data[0]
+            # gpt-image-1 は b64_json で返る。URL が来るモデルならそのまま使う
+            result = data.url or base64.b64decode(data.b64_json)
+            self._update(job_id, status=DONE, result=result)
+        except Exception as e:
+            print(f"Image Job Error ({job_id}): {e}")
+            self._update(job_id, status=ERROR, error=str(e))
+        finally:
+            with self._lock:
+                if self._inflight.get(key) == job_id:
+                    del self._inflight[key]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            if fields.get("status") in (DONE, ERROR):
+                job["finished_at"] = time.time()
+
+    def _purge_finished(self):
+        # ロック保持中に呼ぶこと
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [
+            k for k, j in self._jobs.items()
+            if j["finished_at"] is not None and j["finished_at"] < cutoff
+        ]:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_image_job_runner() -> ImageJobRunner:
+    return ImageJobRunner()
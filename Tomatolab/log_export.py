@@ -0,0 +1,147 @@
+# log_export.py
+import csv
+import datetime
+import io
+import json
+import os
+import tempfile
+import streamlit as st
+from auth_gate import validate_and_parse_id
+from circuit_breaker import CircuitOpenError
+from sheets_utils import JST, iter_log_rows
+
+LOG_COLUMNS = [
+    "timestamp", "student_id", "input", "output", "transcript_id",
+    "prompt_tokens", "completion_tokens", "model",
+]
+EXPORT_PAGE_ROWS = 500
+
+
+def filter_rows(rows, date_from=None, date_to=None, grade=None, klass=None, student_id=None):
+    """
+    期間（YYYY-MM-DD、両端含む）・学年・組・生徒IDで絞り込む。
+    rows は iter_log_rows() のようなイテラブルで、1行ずつ流す。
+    """
+    for row in rows:
+        if len(row) < 2:
+            continue
+        day = row[0][:10]
+        if date_from and day < date_from:
+            continue
+        if date_to and day > date_to:
+            continue
+        sid = str(row[1]).strip()
+        if student_id and sid != student_id:
+            continue
+        if grade or klass:
+            parsed = validate_and_parse_id(sid)
+            if parsed is None:
+                continue
+            if grade and parsed[0] != grade:
+                continue
+            if klass and parsed[1] != klass:
+                continue
+        yield row
+
+
+def _as_record(row):
+    padded = list(row) + [""] * (len(LOG_COLUMNS) - len(row))
+    return dict(zip(LOG_COLUMNS, padded[: len(LOG_COLUMNS)]))
+
+
+def iter_csv(rows):
+    """1行ずつ CSV 文字列にして返す（先頭にヘッダ）"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(LOG_COLUMNS)
+    for row in rows:
+        writer.writerow(_as_record(row).values())
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # ヘッダのみ（0件）のとき
+    if buf.getvalue():
+        yield buf.getvalue()
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        yield json.dumps(_as_record(row), ensure_ascii=False) + "\n"
+
+
+EXPORT_FORMATS = {
+    "CSV": (iter_csv, "text/csv", "csv"),
+    "JSONL": (iter_jsonl, "application/x-ndjson", "jsonl"),
+}
+
+
+def export_logs(fmt: str, **filters):
+    """
+    ログを読み込み→絞り込み→書き出しまでジェネレータでつなぎ、一時ファイルに流し込む。
+    戻り値: (一時ファイルのパス, 件数)。使い終わったら呼び出し側で削除する。
+    """
+    serialize = EXPORT_FORMATS[fmt][0]
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    rows = counted(filter_rows(iter_log_rows(EXPORT_PAGE_ROWS), **filters))
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=f".{EXPORT_FORMATS[fmt][2]}", delete=False) as out:
+        try:
+            for chunk in serialize(rows):
+                out.write(chunk.encode("utf-8"))
+        except Exception:
+            # 途中まで書いたファイルは渡さない
+            out.close()
+            os.unlink(out.name)
+            raise
+    return out.name, count
+
+
+def render_export_panel():
+    """先生用：サイドバーのログ書き出しパネル"""
+    with st.expander("Export Logs"):
+        today = datetime.datetime.now(JST).date()
+        date_from = st.date_input("From", value=today - datetime.timedelta(days=30), key="export_from")
+        date_to = st.date_input("To", value=today, key="export_to")
+        grade = st.selectbox("学年", [None, 1, 2, 3], key="export_grade")
+        klass = st.selectbox("組", [None, 1, 2, 3], key="export_class")
+        student_id = st.text_input("生徒ID（任意）", key="export_student").strip()
+        fmt = st.radio("形式", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+
+        if st.button("書き出し準備", key="export_run"):
+            path = None
+            try:
+                with st.spinner("ログを読み込み中..."):
+                    path, count = export_logs(
+                        fmt,
+                        date_from=date_from.strftime("%Y-%m-%d"),
+                        date_to=date_to.strftime("%Y-%m-%d"),
+                        grade=grade,
+                        klass=klass,
+                        student_id=student_id or None,
+                    )
+                _, mime, ext = EXPORT_FORMATS[fmt]
+                st.caption(f"{count} 件")
+                # download_button はここでファイルを読み込む（TemporaryFile の BufferedRandom は
+                # 受け付けないので、開き直した BufferedReader を渡す）
+                with open(path, "rb") as f:
+                    st.download_button(
+                        "Download",
+                        data=f,
+                        file_name=f"ai_chat_log_{date_from:%Y%m%d}-{date_to:%Y%m%d}.{ext}",
+                        mime=mime,
+                        key="export_download",
+                    )
+            except CircuitOpenError:
+                st.error("ログシートに接続できません（障害中）。しばらくしてからもう一度どうぞ。")
+            except Exception as e:
+                print(f"Export Error: {e}")
+                st.error(f"ログの読み込みに失敗しました: {e}")
+            finally:
+                if path:
+                    os.unlink(path)
@@ -0,0 +1,227 @@
+# model_router.py
+import threading
+import time
+import streamlit as st
+
+# ルールは上から順に評価し、最初に一致したものを使う。
+# st.secrets の [MODEL_ROUTING] に同じ形で書けば上書きできる。
+#   has_image        : 画像添付があるターン
+#   license          : "admin" / "student"
+#   min_prompt_chars : 入力文字数（会話履歴を除く今回の入力）がこれ以上
+DEFAULT_ROUTING = {
+    "slow_ttft_seconds": 6.0,      # これより遅いモデルは予備モデルに切り替える
+    "first_token_timeout": 15.0,   # 予備がある場合、主モデルの応答待ちの上限
+    "ttft_max_age_seconds": 120.0, # これより古い計測値は使わない（主モデルを再び試す）
+    "rules": [
+        {"name": "image", "has_image": True,
+         "model": "gpt-4o", "fallback": "gpt-4o-mini", "max_tokens": 1500},
+        {"name": "admin", "license": "admin",
+         "model": "gpt-4o-mini", "fallback": "gpt-4o", "max_tokens": 2000},
+        {"name": "long", "min_prompt_chars": 600,
+         "model": "gpt-4o", "fallback": "gpt-4o-mini", "max_tokens": 1500},
+        {"name": "default",
+         "model": "gpt-4o-mini", "fallback": "gpt-4o", "max_tokens": 800},
+    ],
+}
+
+TTFT_SMOOTHING = 0.3  # 指数移動平均の重み（新しい観測値側）
+
+
+def get_routing_config() -> dict:
+    config = dict(DEFAULT_ROUTING)
+    override = st.secrets.get("MODEL_ROUTING", None)
+    if override:
+        config.update({k: override[k] for k in override})
+    return config
+
+
+class LatencyTracker:
+    """
+    モデルごとの初回トークンまでの時間（TTFT）の移動平均。プロセス共有。
+    遅いと判定されたモデルは呼ばれなくなり平均が更新されないので、
+    最後の計測から max_age 秒を過ぎた値は「未計測」として扱う。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ttft = {}  # model -> (秒, 計測時刻)
+
+    def record(self, model: str, seconds: float):
+        now = time.monotonic()
+        with self._lock:
+            prev = self._ttft.get(model)
+            if prev is None:
+                self._ttft[model] = (seconds, now)
+            else:
+                self._ttft[model] = (prev[0] + TTFT_SMOOTHING * (seconds - prev[0]), now)
+
+    def get(self, model: str, max_age: float = None):
+        with self._lock:
+            item = self._ttft.get(model)
+            if item is None:
+                return None
+            if max_age is not None and time.monotonic() - item[1] > max_age:
+                # 古い平均は捨てて、次の計測から取り直す
+                del self._ttft[model]
+                return None
+            return item[0]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {model: ttft for model, (ttft, _) in self._ttft.items()}
+
+
+@st.cache_resource
+def get_latency_tracker() -> LatencyTracker:
+    return LatencyTracker()
+
+
+def _rule_matches(rule: dict, prompt: str, has_image: bool, license_type: str) -> bool:
+    if "has_image" in rule and bool(rule["has_image"]) != has_image:
+        return False
+    if "license" in rule and rule["license"] != license_type:
+        return False
+    if "min_prompt_chars" in rule and len(prompt or "") < int(rule["min_prompt_chars"]):
+        return False
+    return True
+
+
+def choose_route(prompt: str, has_image: bool, license_type: str) -> dict:
+    """
+    このターンで使うモデルを決める。
+    戻り値: {"rule", "model", "fallback", "max_tokens", "reason"}
+    """
+    config = get_routing_config()
+    tracker = get_latency_tracker()
+
+    rule = next(
+        (r for r in config["rules"] if _rule_matches(r, prompt, has_image, license_type)),
+        config["rules"][-1],
+    )
+    route = {
+        "rule": rule.get("name", "?"),
+        "model": rule["model"],
+        "fallback": rule.get("fallback"),
+        "max_tokens": int(rule.get("max_tokens", 800)),
+        "reason": "rule",
+    }
+
+    # 主モデルが最近遅いなら、予備モデルの方が速い（または未計測）ときに入れ替える
+    # 計測値が古くなったら主モデルに戻して測り直す（一時的な遅延・429 で入れ替わったままにしない）
+    slow = float(config["slow_ttft_seconds"])
+    max_age = float(config["ttft_max_age_seconds"])
+    primary_ttft = tracker.get(route["model"], max_age)
+    if route["fallback"] and primary_ttft is not None and primary_ttft > slow:
+        fallback_ttft = tracker.get(route["fallback"], max_age)
+        if fallback_ttft is None or fallback_ttft < primary_ttft:
+            route["model"], route["fallback"] = route["fallback"], route["model"]
+            route["reason"] = f"slow primary (ttft {primary_ttft:.1f}s)"
+
+    print(
+        f"[route] rule={route['rule']} model={route['model']} "
+        f"fallback={route['fallback']} max_tokens={route['max_tokens']} "
+        f"reason={route['reason']} prompt_chars={len(prompt or '')} image={has_image}"
+    )
+    return route
+
+
+def _retryable_errors():
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+def stream_chat(client, route: dict, messages: list):
+    """
+    ルートに従ってストリーミングし、本文の差分を順に yield する。
+    最初のトークンが届く前にレート制限・タイムアウトになったら予備モデルでやり直す。
+    実際に使ったモデルは route["used_model"]、使用トークン数は route["usage"] に入る。
+    """
+    config = get_routing_config()
+    tracker = get_latency_tracker()
+    candidates = [route["model"]] + ([route["fallback"]] if route.get("fallback") else [])
+
+    for i, model in enumerate(candidates):
+        has_next = i < len(candidates) - 1
+        # 予備があるときは SDK 内のリトライを切り、待たずに予備へ回す
+        api = (
+            client.with_options(timeout=float(config["first_token_timeout"]), max_retries=0)
+            if has_next
+            else client
+        )
+        route["used_model"] = model
+        started = time.perf_counter()
+        got_first = False
+        try:
+            stream = api.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=route["max_tokens"],
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            try:
+                for chunk in stream:
+                    # 最後のチャンクにだけ使用トークン数が付く（choices は空）
+                    if getattr(chunk, "usage", None):
+                        route["usage"] = {
+                            "prompt_tokens": chunk.usage.prompt_tokens,
+                            "completion_tokens": chunk.usage.completion_tokens,
+                            "model": model,
+                        }
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta is None:
+                        continue
+                    if not got_first:
+                        got_first = True
+                        tracker.record(model, time.perf_counter() - started)
+                    yield delta
+            finally:
+                stream.close()
+            return
+        except _retryable_errors() as e:
+            # 応答途中のエラー、または予備がない場合はそのまま上に投げる
+            if got_first or not has_next:
+                raise
+            # 失敗したモデルは遅い扱いにして、次回以降のルーティングに反映する
+            tracker.record(model, time.perf_counter() - started + float(config["slow_ttft_seconds"]))
+            print(f"[route] fallback {model} -> {candidates[i + 1]}: {type(e).__name__}")
+
+
+# 事前見積もり用の目安（tiktoken を入れずに済むよう文字数から概算する）
+IMAGE_INPUT_TOKENS = 765  # 1024x1024 相当の画像1枚（high detail）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _estimate_text_tokens(text: str) -> int:
+    # 英数字はおよそ4文字で1トークン、日本語などはおよそ1文字1トークン
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def estimate_completion_tokens(text: str) -> int:
+    """途中で打ち切った応答など、usage が返らなかった出力トークン数の概算"""
+    return _estimate_text_tokens(text)
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    """送信前のプロンプトトークン数の概算（やや多めに見積もる）"""
+    total = 0
+    for m in messages:
+        total += MESSAGE_OVERHEAD_TOKENS
+        content = m.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += _estimate_text_tokens(part.get("text", ""))
+                else:
+                    total += IMAGE_INPUT_TOKENS
+        else:
+            total += _estimate_text_tokens(str(content or ""))
+    return total
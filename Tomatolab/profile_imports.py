@@ -0,0 +1,68 @@
+# profile_imports.py
+"""
+起動時の import コストを計測するスクリプト。
+  python profile_imports.py          # 上位 20 件
+  python profile_imports.py -n 40
+`python -X importtime` の出力を集計し、累積時間の大きいモジュール順に表示する。
+"""
+import argparse
+import subprocess
+import sys
+
+# app.py が（直接・間接に）読み込むトップレベルのモジュール
+TARGET_MODULES = [
+    "streamlit",
+    "streamlit.components.v1",
+    "extra_streamlit_components",
+    "dotenv",
+    "gspread",
+    "oauth2client.service_account",
+    "openai",
+]
+
+
+def measure(module: str):
+    """1モジュールを新しいプロセスで import し、(モジュール名, self_us, cumulative_us) のリストを返す"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cum_us, name = line[len("import time:"):].split("|")
+            rows.append((name.strip(), int(self_us), int(cum_us)))
+        except ValueError:
+            continue
+    if proc.returncode != 0:
+        print(f"[WARN] import {module} failed: {proc.stderr.strip().splitlines()[-1:]}")
+        return []
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20, help="表示件数")
+    args = parser.parse_args()
+
+    print(f"{'module':40s} {'cumulative':>12s}")
+    for module in TARGET_MODULES:
+        rows = measure(module)
+        top = [r for r in rows if r[0] == module]
+        if not top:
+            print(f"{module:40s} {'n/a':>12s}")
+            continue
+        print(f"{module:40s} {top[-1][2] / 1000:10.1f}ms")
+
+    print()
+    print(f"--- top {args.n} (全対象を1プロセスで import) ---")
+    rows = measure(", ".join(TARGET_MODULES))
+    for name, _, cum in sorted(rows, key=lambda r: r[2], reverse=True)[: args.n]:
+        print(f"{name:60s} {cum / 1000:10.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
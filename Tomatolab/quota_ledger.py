@@ -0,0 +1,114 @@
+# quota_ledger.py
+import datetime
+import threading
+import streamlit as st
+from sheets_utils import JST, get_initial_usage
+from shared_state import get_shared_state
+
+QUOTA_KINDS = ("chat", "image", "tokens")
+QUOTA_TTL_SECONDS = 2 * 24 * 60 * 60  # 日付が変われば使わないので2日で消える
+SEED_RETRY_SECONDS = 30  # 利用ログが読めなかったとき、次に読み直すまでの間隔
+
+
+class QuotaExceeded(Exception):
+    """予約しようとした枠が上限を超える"""
+
+
+def _today() -> str:
+    return datetime.datetime.now(JST).strftime("%Y-%m-%d")
+
+
+def _key(student_id: str, day: str, kind: str) -> str:
+    return f"quota:{day}:{student_id}:{kind}"
+
+
+class QuotaLedger:
+    """
+    全セッション（複数レプリカなら全レプリカ）で共有する利用回数台帳。
+    キーは (student_id, 日付)。同じ生徒の複数タブ・再ログインでも同じ枠を数える。
+    - 日付ごとに1回だけ利用ログから初期値を読み込む（以降のターンは Sheets を読まない）
+    - try_reserve() で「上限チェック＋予約」を共有ストア上で原子的に行う
+    """
+
+    def __init__(self, state):
+        self._state = state
+        self._lock = threading.Lock()
+        self._seed_locks = {}  # (student_id, date) -> Lock（このプロセス内の二重読み込み防止）
+
+    def _seed_lock_for(self, sid: str, day: str):
+        with self._lock:
+            for k in [k for k in self._seed_locks if k[1] != day]:
+                del self._seed_locks[k]
+            return self._seed_locks.setdefault((sid, day), threading.Lock())
+
+    def ensure_seeded(self, student_id: str):
+        """その日の台帳がなければ利用ログから初期化する（1日1回だけ Sheets を読む）"""
+        self._seed(str(student_id), _today())
+
+    def _seed(self, sid: str, day: str):
+        seeded_key = _key(sid, day, "seeded")
+        if self._state.get(seeded_key) is not None:
+            return
+
+        # Sheets 読み込みはこのプロセス内では同じキーにつき1回。
+        # 他のレプリカと同時に読んでも set_if_absent で先に書いた方だけが反映する
+        with self._seed_lock_for(sid, day):
+            if self._state.get(seeded_key) is not None:
+                return
+            retry_key = _key(sid, day, "seed_retry")
+            if self._state.get(retry_key) is not None:
+                return  # 直前に読めなかったので、しばらくは読み直さない
+            # 先生（"ADMIN" とセッションごとの "ADMIN:..."）は利用ログを読まない
+            used = (0, 0) if sid.split(":")[0] == "ADMIN" else get_initial_usage(sid)
+            if used is None:
+                # 読めなかった分を 0 として確定させると、その日の枠がまるごと復活してしまう。
+                # 確定はせず少し後に読み直す。それまでは台帳で数えた分だけで判定する
+                self._state.set(retry_key, 1, ttl=SEED_RETRY_SECONDS)
+                return
+            if not self._state.set_if_absent(seeded_key, 1, ttl=QUOTA_TTL_SECONDS):
+                return
+            chat_used, tokens_used = used
+            # 読めるまでの間に予約した分もあるので、大きい方に合わせる
+            self._raise_to(_key(sid, day, "chat"), chat_used)
+            self._raise_to(_key(sid, day, "tokens"), tokens_used)
+
+    def _raise_to(self, key: str, value: int):
+        current = self._state.get(key) or 0
+        if value > current:
+            self._state.incr(key, value - current, ttl=QUOTA_TTL_SECONDS)
+
+    def usage(self, student_id: str, kind: str) -> int:
+        sid, day = str(student_id), _today()
+        self._seed(sid, day)
+        return self._state.get(_key(sid, day, kind)) or 0
+
+    def try_reserve(self, student_id: str, kind: str, limit: int, amount: int = 1):
+        """
+        使用量 + amount が上限以下なら予約して日付文字列を返す。超えるなら None。
+        返した日付は release() / settle() に渡す（日付をまたいでも正しい枠に戻すため）。
+        """
+        if kind not in QUOTA_KINDS:
+            raise ValueError(f"unknown quota kind: {kind}")
+        sid, day = str(student_id), _today()
+        self._seed(sid, day)
+        key = _key(sid, day, kind)
+        if self._state.incr_if_below(key, limit, amount, ttl=QUOTA_TTL_SECONDS) is None:
+            return None
+        return day
+
+    def release(self, student_id: str, kind: str, day: str, amount: int = 1):
+        """try_reserve() の予約を取り消す（API エラー時など）"""
+        self._state.decr(_key(str(student_id), day, kind), amount)
+
+    def settle(self, student_id: str, kind: str, day: str, reserved: int, actual: int):
+        """見積もりで予約した分を実際の使用量に合わせる（上限を超えても記録はする）"""
+        key = _key(str(student_id), day, kind)
+        if actual > reserved:
+            self._state.incr(key, actual - reserved, ttl=QUOTA_TTL_SECONDS)
+        elif actual < reserved:
+            self._state.decr(key, reserved - actual)
+
+
+@st.cache_resource
+def get_quota_ledger() -> QuotaLedger:
+    return QuotaLedger(get_shared_state())
@@ -0,0 +1,222 @@
+# rerun_profiler.py
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import streamlit as st
+
+# 操作のたびに app.py が上から再実行されるので、区間ごとの所要時間を測って
+# 全セッション分をこのプロセスにまとめる。既定は off（測らない）。
+# 環境変数 TOMATO_PROFILE で起動時から有効にできる。先生はサイドバーから切り替えられる。
+#   time        区間ごとの所要時間だけ
+#   cprofile    ＋区間内の関数ごとの内訳（cProfile）
+#   tracemalloc ＋区間ごとのメモリ確保量（tracemalloc）
+PROFILE_MODES = ("off", "time", "cprofile", "tracemalloc")
+PROFILE_ENV = "TOMATO_PROFILE"
+RECENT_SAMPLES = 200  # p95 用に区間ごとに残す直近の件数
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 20
+
+
+def _mode_from_env() -> str:
+    value = os.environ.get(PROFILE_ENV, "").strip().lower()
+    if value in ("1", "true", "on"):
+        return "time"
+    return value if value in PROFILE_MODES else "off"
+
+
+class RerunProfiler:
+    """
+    区間（security_gate・サイドバー・履歴の描画など）ごとの所要時間の集計。
+    mode はプロセス全体で1つ（切り替えると全セッションの計測が変わる）。
+    - cProfile は同時に1つしか動かせないので、他のセッションが計測中の区間は時間だけ測る
+    - tracemalloc の確保量はプロセス全体の増減なので、同時アクセスが多いと目安になる
+    """
+
+    def __init__(self, mode: str = "off"):
+        self._lock = threading.Lock()
+        self._cprofile_lock = threading.Lock()
+        self.mode = "off"
+        self.reset()
+        self.set_mode(mode)
+
+    def reset(self):
+        with self._lock:
+            self._sections = {}  # name -> 集計値
+            self._stats = {}  # name -> pstats.Stats（全セッション合算）
+            self.since = time.time()
+
+    def set_mode(self, mode: str):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"unknown profile mode: {mode}")
+        if mode == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif mode != "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.mode = mode
+
+    @contextlib.contextmanager
+    def section(self, name: str):
+        """with の中身を1区間として測る（st.rerun() などの制御例外で抜けても記録する）"""
+        mode = self.mode
+        if mode == "off":
+            yield
+            return
+
+        prof = None
+        if mode == "cprofile" and self._cprofile_lock.acquire(blocking=False):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # 別のプロファイラ（デバッガなど）が動いている
+                self._cprofile_lock.release()
+                prof = None
+        tracing = mode == "tracemalloc" and tracemalloc.is_tracing()
+        mem_before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if prof is not None:
+                prof.disable()
+                self._cprofile_lock.release()
+            alloc = None
+            if tracing and tracemalloc.is_tracing():
+                alloc = tracemalloc.get_traced_memory()[0] - mem_before
+            self._record(name, elapsed, prof, alloc)
+
+    def _record(self, name, elapsed, prof, alloc):
+        with self._lock:
+            sec = self._sections.get(name)
+            if sec is None:
+                sec = self._sections[name] = {
+                    "calls": 0, "total": 0.0, "max": 0.0, "last": 0.0,
+                    "recent": collections.deque(maxlen=RECENT_SAMPLES),
+                    "alloc_calls": 0, "alloc_total": 0,
+                }
+            sec["calls"] += 1
+            sec["total"] += elapsed
+            sec["max"] = max(sec["max"], elapsed)
+            sec["last"] = elapsed
+            sec["recent"].append(elapsed)
+            if alloc is not None:
+                sec["alloc_calls"] += 1
+                sec["alloc_total"] += alloc
+            if prof is not None:
+                if name in self._stats:
+                    self._stats[name].add(prof)
+                else:
+                    self._stats[name] = pstats.Stats(prof)
+
+    def report(self) -> list:
+        """区間ごとの集計（合計時間の大きい順）。st.dataframe にそのまま渡せる"""
+        rows = []
+        with self._lock:
+            for name, sec in self._sections.items():
+                recent = sorted(sec["recent"])
+                row = {
+                    "section": name,
+                    "calls": sec["calls"],
+                    "total_ms": round(sec["total"] * 1000, 1),
+                    "mean_ms": round(sec["total"] / sec["calls"] * 1000, 2),
+                    "p95_ms": round(recent[int(0.95 * (len(recent) - 1))] * 1000, 2),
+                    "max_ms": round(sec["max"] * 1000, 2),
+                    "last_ms": round(sec["last"] * 1000, 2),
+                }
+                if sec["alloc_calls"]:
+                    row["alloc_kb_mean"] = round(sec["alloc_total"] / sec["alloc_calls"] / 1024, 1)
+                rows.append(row)
+        rows.sort(key=lambda r: r["total_ms"], reverse=True)
+        return rows
+
+    def profiled_sections(self) -> list:
+        with self._lock:
+            return sorted(self._stats)
+
+    def function_report(self, name: str, limit: int = TOP_FUNCTIONS) -> list:
+        """cProfile の結果を関数ごとに（累積時間の大きい順）"""
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                return []
+            items = list(stats.stats.items())
+        rows = [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({func})",
+                "calls": nc,
+                "tottime_ms": round(tt * 1000, 2),
+                "cumtime_ms": round(ct * 1000, 2),
+            }
+            for (filename, line, func), (cc, nc, tt, ct, callers) in items
+        ]
+        rows.sort(key=lambda r: r["cumtime_ms"], reverse=True)
+        return rows[:limit]
+
+
+def top_allocations(limit: int = TOP_ALLOCATIONS) -> list:
+    """tracemalloc の現時点のスナップショットから、確保量の多い行"""
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+    )
+    return [
+        {
+            "location": f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+@st.cache_resource
+def get_rerun_profiler() -> RerunProfiler:
+    return RerunProfiler(_mode_from_env())
+
+
+def profile_section(name: str):
+    """app.py 用：with profile_section("sidebar"): のように区間を囲む"""
+    return get_rerun_profiler().section(name)
+
+
+def render_profiler_panel():
+    """先生用：サイドバーの計測パネル（表の列見出しをクリックすると並べ替えられる）"""
+    profiler = get_rerun_profiler()
+    with st.expander("Rerun Profiler"):
+        mode = st.selectbox(
+            "計測モード（全セッション）",
+            PROFILE_MODES,
+            index=PROFILE_MODES.index(profiler.mode),
+        )
+        if mode != profiler.mode:
+            profiler.set_mode(mode)
+
+        since = time.strftime("%H:%M:%S", time.localtime(profiler.since))
+        st.caption(f"{since} からの集計")
+        rows = profiler.report()
+        if rows:
+            st.dataframe(rows, hide_index=True, use_container_width=True)
+        else:
+            st.caption("まだ計測結果がありません。")
+
+        sections = profiler.profiled_sections()
+        if sections:
+            name = st.selectbox("関数ごとの内訳（cProfile）", sections, key="profiler_section")
+            st.dataframe(profiler.function_report(name), hide_index=True, use_container_width=True)
+
+        if mode == "tracemalloc" and st.button("メモリのスナップショット", key="profiler_snapshot"):
+            st.dataframe(top_allocations(), hide_index=True, use_container_width=True)
+
+        if st.button("集計をリセット", key="profiler_reset"):
+            profiler.reset()
+            st.rerun()
@@ -0,0 +1,104 @@
+# session_store.py
+import hashlib
+import hmac
+import secrets
+import time
+import streamlit as st
+from shared_state import get_shared_state
+
+SESSION_COOKIE_NAME = "tomato_session"
+SESSION_TTL_SECONDS = 8 * 60 * 60  # トークン自体の有効期限（1日の授業時間をカバーする程度）
+# 共用 PC でログアウトし忘れても次の生徒に引き継がれないよう、操作がない状態が
+# この時間続いたらサーバ側のセッションを消す（リロード・再接続ではログインが必要になる）
+SESSION_IDLE_SECONDS = 15 * 60
+
+
+@st.cache_resource
+def _get_signing_key() -> bytes:
+    # SESSION_SECRET 未設定なら共有ストアに乱数鍵を1つだけ作り、全レプリカで使う
+    # （プロセス内ストアの場合は再起動でトークンが無効になる）
+    secret = st.secrets.get("SESSION_SECRET", None)
+    if secret:
+        return str(secret).encode("utf-8")
+    state = get_shared_state()
+    state.set_if_absent("session:signing_key", secrets.token_hex(32))
+    return state.get("session:signing_key").encode("utf-8")
+
+
+def _sign(payload: str) -> str:
+    return hmac.new(_get_signing_key(), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+class SessionStore:
+    """
+    ログイン済みセッションのサーバ側キャッシュ（共有ストア上の session:* キー）。
+    Cookie には署名付きトークン（session_id.有効期限.署名）だけを置き、
+    ID・ライセンス種別はサーバ側に持つ。revoke() で即時無効化できる。
+    サーバ側の記録は SESSION_IDLE_SECONDS で切れ、touch() で延長する。
+    """
+
+    def __init__(self, state):
+        self._state = state
+
+    def create(self, student_id: str, license_type: str):
+        """新しいセッションを登録し (token, expires) を返す"""
+        session_id = secrets.token_urlsafe(24)
+        expires = int(time.time()) + SESSION_TTL_SECONDS
+        self._state.set(
+            f"session:{session_id}",
+            {"student_id": student_id, "license_type": license_type, "expires": expires},
+            ttl=SESSION_IDLE_SECONDS,
+        )
+        payload = f"{session_id}.{expires}"
+        return f"{payload}.{_sign(payload)}", expires
+
+    def resolve(self, token: str):
+        """署名・期限・サーバ側登録を確認し、セッション情報を返す（無効なら None）"""
+        session_id = self._verify(token)
+        if not session_id:
+            return None
+        rec = self._state.get(f"session:{session_id}")
+        if not rec or rec["expires"] < time.time():
+            return None
+        return rec
+
+    def touch(self, token: str) -> bool:
+        """操作があったのでアイドル期限を延ばす（トークン自体の期限は超えない）。切れていれば False"""
+        session_id = self._verify(token)
+        if not session_id:
+            return False
+        rec = self._state.get(f"session:{session_id}")
+        if not rec:
+            return False
+        remaining = int(rec["expires"] - time.time())
+        if remaining <= 0:
+            return False
+        self._state.set(
+            f"session:{session_id}", rec, ttl=min(SESSION_IDLE_SECONDS, remaining)
+        )
+        return True
+
+    def revoke(self, token: str):
+        session_id = self._verify(token)
+        if not session_id:
+            return
+        self._state.delete(f"session:{session_id}")
+
+    def _verify(self, token):
+        if not token or not isinstance(token, str):
+            return None
+        try:
+            session_id, expires, sig = token.rsplit(".", 2)
+            expires = int(expires)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(sig, _sign(f"{session_id}.{expires}")):
+            return None
+        if expires < time.time():
+            return None
+        return session_id
+
+
+@st.cache_resource
+def get_session_store() -> SessionStore:
+    return SessionStore(get_shared_state())
@@ -0,0 +1,203 @@
+# shared_state.py
+import copy
+import json
+import os
+import threading
+import time
+import streamlit as st
+
+# 複数レプリカで動かすときは REDIS_URL（st.secrets または環境変数）を設定する
+# （redis パッケージを追加でインストールすること）。
+# 未設定なら1プロセス内だけで共有する実装を使う。設定してあるのに接続できないときは
+# プロセス内の実装には切り替えずエラーにする。
+#
+# 共有するもの（キーの接頭辞）
+#   quota:*    利用回数台帳（quota_ledger.py）
+#   session:*  ログインセッション（session_store.py）
+#   roster     ロスターのキャッシュ（sheets_utils.py）
+#   bucket:*   レート制限のトークンバケット（sheets_utils.py）
+
+
+class InProcessBackend:
+    """1プロセス内で共有する実装（既定）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # key -> (value, expires_at or None)
+
+    def _live(self, key):
+        # ロック保持中に呼ぶこと
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def _expiry(self, ttl):
+        return time.time() + ttl if ttl else None
+
+    def get(self, key):
+        # Redis 版と同じく、返した値を書き換えても保存内容に影響しないようにコピーを返す
+        with self._lock:
+            item = self._live(key)
+            return copy.deepcopy(item[0]) if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (copy.deepcopy(value), self._expiry(ttl))
+
+    def set_if_absent(self, key, value, ttl=None) -> bool:
+        with self._lock:
+            if self._live(key):
+                return False
+            self._data[key] = (copy.deepcopy(value), self._expiry(ttl))
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr_if_below(self, key, limit, amount=1, ttl=None):
+        """現在値 + amount が limit 以下なら加算して新しい値を返す。超えるなら None"""
+        with self._lock:
+            item = self._live(key)
+            current, expires_at = item if item else (0, self._expiry(ttl))
+            if current + amount > limit:
+                return None
+            self._data[key] = (current + amount, expires_at)
+            return current + amount
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            item = self._live(key)
+            current, expires_at = item if item else (0, self._expiry(ttl))
+            self._data[key] = (current + amount, expires_at)
+            return current + amount
+
+    def decr(self, key, amount=1):
+        with self._lock:
+            item = self._live(key)
+            if item:
+                self._data[key] = (max(0, item[0] - amount), item[1])
+
+    def take_token(self, key, rate: float, capacity: int) -> bool:
+        """トークンバケット。1個取れたら True（rate は 1秒あたりの補充数）"""
+        now = time.time()
+        with self._lock:
+            item = self._live(key)
+            tokens, last = item[0] if item else (capacity, now)
+            tokens = min(capacity, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._data[key] = ((tokens, now), None)
+                return False
+            self._data[key] = ((tokens - 1, now), None)
+            return True
+
+
+_INCR_IF_BELOW = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local amount = tonumber(ARGV[2])
+if current + amount > tonumber(ARGV[1]) then
+    return nil
+end
+local value = redis.call('INCRBY', KEYS[1], amount)
+if tonumber(ARGV[3]) > 0 and redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return value
+"""
+
+_DECR_FLOOR = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current <= 0 then return 0 end
+local value = math.max(0, current - tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], value, 'KEEPTTL')
+return value
+"""
+
+_TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local ok = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    ok = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return ok
+"""
+
+
+class RedisBackend:
+    """
+    Redis（または互換サーバ）で全レプリカと共有する実装。
+    判定と更新が同時に必要な操作は Lua スクリプトで原子的に行う。
+    client には redis-py 互換のクライアント（テストでは fakeredis など）を渡せる。
+    """
+
+    def __init__(self, client):
+        self._r = client
+        self._incr_if_below = client.register_script(_INCR_IF_BELOW)
+        self._decr_floor = client.register_script(_DECR_FLOOR)
+        self._take_token = client.register_script(_TAKE_TOKEN)
+
+    @classmethod
+    def from_url(cls, url: str):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        raw = self._r.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._r.set(key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def set_if_absent(self, key, value, ttl=None) -> bool:
+        return bool(self._r.set(key, json.dumps(value, ensure_ascii=False), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self._r.delete(key)
+
+    def incr_if_below(self, key, limit, amount=1, ttl=None):
+        value = self._incr_if_below(keys=[key], args=[limit, amount, int(ttl or 0)])
+        return int(value) if value is not None else None
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self._r.incrby(key, amount)
+        if ttl and self._r.ttl(key) < 0:
+            self._r.expire(key, ttl)
+        return int(value)
+
+    def decr(self, key, amount=1):
+        self._decr_floor(keys=[key], args=[amount])
+
+    def take_token(self, key, rate: float, capacity: int) -> bool:
+        return bool(self._take_token(keys=[key], args=[rate, capacity, time.time()]))
+
+
+@st.cache_resource
+def get_shared_state():
+    url = st.secrets.get("REDIS_URL", None) or os.environ.get("REDIS_URL")
+    if not url:
+        return InProcessBackend()
+    # REDIS_URL があるのは複数レプリカ構成。プロセス内に切り替えると回数の二重計上や
+    # レプリカごとに署名鍵が変わる（Cookie が通らない）問題が起きるので、切り替えずに止める。
+    # 例外は cache_resource にキャッシュされないので、次の実行で接続をやり直す
+    try:
+        backend = RedisBackend.from_url(url)
+        backend.get("tomato:ping")
+    except Exception as e:
+        print(f"[shared_state] Redis unavailable: {e}")
+        raise RuntimeError(f"shared state (REDIS_URL) unavailable: {e}") from e
+    print("[shared_state] using Redis backend")
+    return backend
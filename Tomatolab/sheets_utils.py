@@ -1,18 +1,44 @@
 # sheets_utils.py
 import datetime
+import json
+import os
+import threading
 import time
 import random
+from pathlib import Path
 import streamlit as st
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from gspread.exceptions import APIError
+from circuit_breaker import CircuitOpenError, get_sheets_breaker
+from shared_state import get_shared_state
+from transcript_store import get_transcript_store, strip_images
+
+# gspread / oauth2client は読み込みが重いので、実際に Sheets を使うときまで import しない
+# （ログイン画面の表示を待たせないため。warmup.py がバックグラウンドで先に読み込む）
+def _api_error():
+    from gspread.exceptions import APIError
+    return APIError
 
 LOG_SHEET_NAME = "AI_Chat_Log"            # 利用ログ
 STUDENT_SHEET_NAME = "AI_Student_Master"  # アカウントマスタ
+LOG_PREVIEW_CHARS = 200                   # ログシートに書く本文プレビューの長さ
 
 # 日本時間（JST）の設定
 JST = datetime.timezone(datetime.timedelta(hours=+9), 'JST')
 
+# Sheets 障害時用のローカル保存先（ロスターのスナップショットと書き込みの退避）
+LOCAL_STATE_DIR = Path(
+    os.environ.get("TOMATO_STATE_DIR", Path(__file__).parent / "state")
+)
+ROSTER_SNAPSHOT_FILE = LOCAL_STATE_DIR / "roster_snapshot.json"
+SPOOL_FILE = LOCAL_STATE_DIR / "sheets_spool.jsonl"
+_spool_lock = threading.Lock()
+
+# Sheets API の呼び出しペース（全レプリカ合計。既定の枠は 1ユーザーあたり 60回/分）
+SHEETS_RATE_PER_SEC = 1.0
+SHEETS_BURST = 20
+SHEETS_RATE_MAX_WAIT = 5.0
+SHEETS_TIMEOUT = 15.0  # 1回の HTTP 呼び出しの上限（応答しない Sheets で待ち続けない）
+ROSTER_CACHE_TTL = 60
+
 # ★キャッシュ設定
 @st.cache_resource(ttl=600)
 def get_cached_gspread_client():
@@ -22,13 +48,24 @@ def get_cached_gspread_client():
     ]
     if "gcp_service_account" not in st.secrets:
         return None
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     creds_dict = st.secrets["gcp_service_account"]
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    return gspread.authorize(creds)
+    client = gspread.authorize(creds)
+    client.set_timeout(SHEETS_TIMEOUT)
+    return client
 
+# ★クライアント作成は API を呼ばない（キャッシュ済みのことが多い）のでブレーカーには記録しない。
+#   障害中（open）は待たずに即 None を返す
 def get_gspread_client_with_retry():
+    breaker = get_sheets_breaker()
     max_retries = 3
     for i in range(max_retries):
+        if breaker.state == "open":
+            print("Auth skipped: Sheets circuit open")
+            return None
         try:
             return get_cached_gspread_client()
         except Exception as e:
@@ -43,11 +80,15 @@ def open_sheet_with_retry(sheet_name):
     if not client:
         return None
     
+    breaker = get_sheets_breaker()
     max_retries = 5
     for i in range(max_retries):
         try:
-            return client.open(sheet_name).sheet1
-        except APIError as e:
+            return breaker.call(lambda: client.open(sheet_name).sheet1)
+        except CircuitOpenError:
+            print(f"Open Sheet skipped ({sheet_name}): Sheets circuit open")
+            return None
+        except _api_error() as e:
             if i == max_retries - 1:
                 print(f"Open Sheet Error ({sheet_name}): {e}")
                 return None
@@ -59,73 +100,319 @@ def open_sheet_with_retry(sheet_name):
             return None
     return None
 
+
+def _sheets_call(fn, *args, **kwargs):
+    """
+    Sheets API 呼び出しの共通処理。APIError は1回だけ待って再試行する。
+    ブレーカーが開いていれば呼ばずに CircuitOpenError。
+    """
+    breaker = get_sheets_breaker()
+    if breaker.state == "open":
+        raise CircuitOpenError("sheets")
+    _wait_for_sheets_token()
+
+    def attempt():
+        try:
+            return fn(*args, **kwargs)
+        except _api_error():
+            time.sleep(1)
+            return fn(*args, **kwargs)
+
+    return breaker.call(attempt)
+
+
+def _wait_for_sheets_token():
+    """共有トークンバケットで呼び出しペースを揃える（待ちすぎる場合はそのまま進む）"""
+    state = get_shared_state()
+    deadline = time.monotonic() + SHEETS_RATE_MAX_WAIT
+    while not state.take_token("bucket:sheets", SHEETS_RATE_PER_SEC, SHEETS_BURST):
+        if time.monotonic() >= deadline:
+            print("Sheets rate limiter: wait budget exhausted")
+            return
+        time.sleep(0.2)
+
+
+def is_sheets_degraded() -> bool:
+    """Sheets 障害でスナップショット・退避書き込みで動いている間 True"""
+    return get_sheets_breaker().state != "closed"
+
+# client.open() はファイル検索になり遅いので、開いたワークシートもキャッシュする
+@st.cache_resource(ttl=600)
+def _get_cached_worksheet(sheet_name):
+    sheet = open_sheet_with_retry(sheet_name)
+    if sheet is None:
+        # 失敗はキャッシュさせない（例外は cache_resource に保存されない）
+        raise RuntimeError(f"cannot open sheet: {sheet_name}")
+    return sheet
+
+def _get_worksheet(sheet_name):
+    try:
+        return _get_cached_worksheet(sheet_name)
+    except RuntimeError:
+        return None
+
 def get_log_sheet():
-    return open_sheet_with_retry(LOG_SHEET_NAME)
+    return _get_worksheet(LOG_SHEET_NAME)
 
 def get_student_sheet():
-    return open_sheet_with_retry(STUDENT_SHEET_NAME)
+    return _get_worksheet(STUDENT_SHEET_NAME)
+
+
+# ★ロスター（アカウントマスタ）のキャッシュ。全レプリカで共有し、PIN 更新時は消す
+def _fetch_roster():
+    state = get_shared_state()
+    cached = state.get("roster")
+    if cached:
+        return cached["header"], cached["records"]
+
+    sheet = get_student_sheet()
+    if not sheet:
+        # 取得失敗はキャッシュさせない
+        raise RuntimeError("student sheet unavailable")
 
+    header = _sheets_call(sheet.row_values, 1)
+    records = _sheets_call(sheet.get_all_records)
+    state.set("roster", {"header": header, "records": records}, ttl=ROSTER_CACHE_TTL)
+    _save_roster_snapshot(header, records)
+    return header, records
 
-def get_initial_usage_count(student_id: str) -> int:
+
+def _invalidate_roster():
+    get_shared_state().delete("roster")
+
+
+def _save_roster_snapshot(header, records):
+    try:
+        LOCAL_STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = ROSTER_SNAPSHOT_FILE.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"header": header, "records": records}, f, ensure_ascii=False)
+        os.chmod(tmp, 0o600)  # PIN を含むので本人以外読めないように
+        os.replace(tmp, ROSTER_SNAPSHOT_FILE)
+    except Exception as e:
+        print(f"Roster Snapshot Error: {e}")
+
+
+def _load_roster_snapshot():
+    try:
+        with open(ROSTER_SNAPSHOT_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        return data["header"], data["records"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _patch_roster_snapshot(row_index: int, values: dict):
+    """障害中に書いた値（新しい PIN など）をスナップショットにも反映する"""
+    snapshot = _load_roster_snapshot()
+    if not snapshot:
+        return
+    header, records = snapshot
+    if 0 <= row_index - 2 < len(records):
+        records[row_index - 2].update(values)
+        _save_roster_snapshot(header, records)
+
+
+def load_roster():
+    """
+    (header, records) を返す。Sheets が使えないときは最後に取得できたスナップショット。
+    どちらもなければ RuntimeError。
+    """
+    try:
+        return _fetch_roster()
+    except Exception as e:
+        snapshot = _load_roster_snapshot()
+        if snapshot is None:
+            raise RuntimeError(f"roster unavailable: {e}")
+        print(f"Roster served from snapshot: {e}")
+        return snapshot
+
+
+def get_initial_usage(student_id: str):
+    """
+    本日の (利用回数, 使用トークン数) を利用ログから数える。
+    トークン数は F 列（prompt）+ G 列（completion）の合計。
+    ログが読めなかったときは None（0 件と区別するため）。
+    """
     try:
         sheet = get_log_sheet()
         if not sheet:
-            return 0
+            print("Count Check Error: log sheet unavailable")
+            return None
         
-        # 読み込みリトライ
-        try:
-            data = sheet.get_all_values()
-        except APIError:
-            time.sleep(1)
-            data = sheet.get_all_values()
+        data = _sheets_call(sheet.get_all_values)
 
         if len(data) < 2:
-            return 0
+            return 0, 0
 
         count = 0
+        tokens = 0
         target_date = datetime.datetime.now(JST).strftime("%Y-%m-%d")
         
         for row in data:
             if len(row) > 1:
                 if target_date in row[0] and str(student_id) == str(row[1]):
                     count += 1
-        return count
+                    for cell in row[5:7]:
+                        if str(cell).isdigit():
+                            tokens += int(cell)
+        return count, tokens
     except Exception as e:
         print(f"Count Check Error: {e}")
-        return 0
+        return None
+
 
+def _preview(text, limit=LOG_PREVIEW_CHARS):
+    text = str(text or "")
+    return text if len(text) <= limit else text[:limit] + "…"
 
-def save_log_to_sheet(student_id, input_text, output_text):
+
+def save_log_to_sheet(student_id, input_text, output_text, context=None, usage=None, truncated=False):
+    """
+    全文（会話コンテキスト含む）はローカルのトランスクリプトに保存し、
+    シートには先頭だけのプレビューと transcript ID を書く。
+    usage: {"prompt_tokens", "completion_tokens", "model"}（F〜H 列に記録）
+    truncated: 生成を途中で止めた応答なら True（トークン数は概算になる）
+    """
+    usage = usage or {}
+    now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+    transcript_id = ""
     try:
-        sheet = get_log_sheet()
-        if not sheet:
+        transcript_id = get_transcript_store().append(
+            {
+                "student_id": student_id,
+                "logged_at": now,
+                "input": input_text,
+                "output": output_text,
+                "context": strip_images(context),
+                "usage": usage,
+                "truncated": truncated,
+            }
+        )
+    except Exception as e:
+        print(f"Transcript Error: {e}")
+
+    row = [
+        now, student_id, _preview(input_text),
+        ("[truncated] " if truncated else "") + _preview(output_text), transcript_id,
+        usage.get("prompt_tokens", ""), usage.get("completion_tokens", ""), usage.get("model", ""),
+    ]
+    _write_or_spool({"op": "append_row", "sheet": LOG_SHEET_NAME, "row": row})
+
+
+# ==============================================================================
+# 書き込みの退避と再送（Sheets 障害時）
+# ==============================================================================
+def _apply_op(op):
+    sheet = _get_worksheet(op["sheet"])
+    if not sheet:
+        raise RuntimeError(f"sheet unavailable: {op['sheet']}")
+    if op["op"] == "append_row":
+        _sheets_call(sheet.append_row, op["row"])
+    elif op["op"] == "update_cell":
+        _sheets_call(sheet.update_cell, op["row"], op["col"], op["value"])
+
+
+def _spool_pending() -> bool:
+    try:
+        return SPOOL_FILE.stat().st_size > 0
+    except OSError:
+        return False
+
+
+def _spool(op):
+    with _spool_lock:
+        LOCAL_STATE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(SPOOL_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(op, ensure_ascii=False) + "\n")
+
+
+def replay_spool():
+    """
+    退避した書き込みを順番どおりに再送する。途中で失敗したら残りを退避したままにする。
+    連続するログ行は append_rows でまとめて1回で送る。
+    """
+    with _spool_lock:
+        if not _spool_pending():
             return
-        
-        now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 書き込みリトライ
+        with open(SPOOL_FILE, encoding="utf-8") as f:
+            ops = [json.loads(line) for line in f if line.strip()]
+
+        done = 0
         try:
-            sheet.append_row([now, student_id, input_text, output_text])
-        except APIError:
-            time.sleep(2)
-            sheet.append_row([now, student_id, input_text, output_text])
-            
+            while done < len(ops):
+                op = ops[done]
+                if op["op"] == "append_row":
+                    batch = []
+                    while (
+                        done + len(batch) < len(ops)
+                        and ops[done + len(batch)]["op"] == "append_row"
+                        and ops[done + len(batch)]["sheet"] == op["sheet"]
+                    ):
+                        batch.append(ops[done + len(batch)]["row"])
+                    sheet = _get_worksheet(op["sheet"])
+                    if not sheet:
+                        raise RuntimeError(f"sheet unavailable: {op['sheet']}")
+                    _sheets_call(sheet.append_rows, batch)
+                    done += len(batch)
+                else:
+                    _apply_op(op)
+                    done += 1
+        except Exception as e:
+            print(f"Spool Replay stopped ({len(ops) - done} left): {e}")
+
+        tmp = SPOOL_FILE.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for op in ops[done:]:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+        os.replace(tmp, SPOOL_FILE)
+        if done:
+            print(f"Spool Replay: {done} write(s) sent")
+
+
+def _write_or_spool(op):
+    """Sheets に書く。使えなければローカルに退避し、次の書き込み時に再送する"""
+    # 退避分が残っている間は順番を守るため先に再送する
+    if _spool_pending():
+        replay_spool()
+        if _spool_pending():
+            _spool(op)
+            return
+    try:
+        _apply_op(op)
     except Exception as e:
-        print(f"Log Error: {e}")
+        print(f"Write spooled ({op['op']}): {e}")
+        _spool(op)
 
 
-def find_student_record(student_id: str):
-    sheet = get_student_sheet()
+def iter_log_rows(page_rows: int = 500):
+    """
+    利用ログを page_rows 行ずつ範囲指定で読み、1行ずつ返すジェネレータ。
+    シート全体を一度に読み込まないので、ログが大きくてもメモリは一定。
+    """
+    sheet = get_log_sheet()
     if not sheet:
-        return None, None, []
+        return
+
+    start = 2  # 1行目はヘッダ
+    while True:
+        end = start + page_rows - 1
+        cell_range = f"A{start}:H{end}"
+        rows = _sheets_call(sheet.get_values, cell_range)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        if len(rows) < page_rows:
+            return
+        start = end + 1
+
 
+def find_student_record(student_id: str):
     try:
-        header = sheet.row_values(1)
-        records = sheet.get_all_records()
-    except APIError:
-        time.sleep(1)
-        header = sheet.row_values(1)
-        records = sheet.get_all_records()
+        header, records = load_roster()
+    except RuntimeError:
+        return None, None, []
 
     for idx, rec in enumerate(records, start=2):
         # ID照合
@@ -143,52 +430,44 @@ def find_student_record(student_id: str):
     return None, None, header
 
 
-def update_student_pin_and_login(row_index: int, new_pin: str, is_new: bool = False):
-    sheet = get_student_sheet()
-    if not sheet:
-        return
+def _roster_col(header, col_name):
+    return header.index(col_name) + 1 if col_name in header else None
 
+
+def update_student_pin_and_login(row_index: int, new_pin: str, is_new: bool = False):
     try:
-        header = sheet.row_values(1)
-    except:
+        header, _ = load_roster()
+    except RuntimeError:
         return
 
-    def col_idx(col_name):
-        return header.index(col_name) + 1 if col_name in header else None
-
     now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+    updates = {"pin": new_pin, "last_login": now}
+    if is_new:
+        updates["created_at"] = now
 
-    try:
-        pin_col = col_idx("pin")
-        if pin_col:
-            sheet.update_cell(row_index, pin_col, new_pin)
+    for col_name, value in updates.items():
+        col = _roster_col(header, col_name)
+        if col:
+            _write_or_spool({
+                "op": "update_cell", "sheet": STUDENT_SHEET_NAME,
+                "row": row_index, "col": col, "value": value,
+            })
 
-        if is_new:
-            created_col = col_idx("created_at")
-            if created_col:
-                sheet.update_cell(row_index, created_col, now)
-
-        last_login_col = col_idx("last_login")
-        if last_login_col:
-            sheet.update_cell(row_index, last_login_col, now)
-    except APIError:
-        pass
+    # 新しい PIN を次のログインで確実に読むため（障害中はスナップショットに反映）
+    _patch_roster_snapshot(row_index, updates)
+    _invalidate_roster()
 
 
 def update_last_login_only(row_index: int):
-    sheet = get_student_sheet()
-    if not sheet:
-        return
-    
     try:
-        header = sheet.row_values(1)
-        if "last_login" in header:
-            col = header.index("last_login") + 1
-            now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                sheet.update_cell(row_index, col, now)
-            except APIError:
-                time.sleep(1)
-                sheet.update_cell(row_index, col, now)
-    except Exception as e:
-        print(f"Login Update Error: {e}")
+        header, _ = load_roster()
+    except RuntimeError:
+        return
+
+    col = _roster_col(header, "last_login")
+    if col:
+        now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+        _write_or_spool({
+            "op": "update_cell", "sheet": STUDENT_SHEET_NAME,
+            "row": row_index, "col": col, "value": now,
+        })
@@ -0,0 +1,466 @@
+# theme.py
+import base64
+import hashlib
+import json
+import re
+from pathlib import Path
+import streamlit as st
+
+BASE_DIR = Path(__file__).parent
+
+# テーマごとの色。CSS カスタムプロパティと背景アニメーションの両方で使う
+THEMES = {
+    "light": {
+        "bg_color": "#ffffff",
+        "p_color_main": "#000000",
+        "p_color_sub": "#cccccc",
+        "text_color": "#333333",
+        "bg_rgba": "rgba(255, 255, 255, 0.7)",
+        "input_bg": "rgba(245, 245, 245, 0.95)",
+        "border_color": "rgba(0, 0, 0, 0.1)",
+        "mask_color": "#ffffff",
+    },
+    "dark": {
+        "bg_color": "#000000",
+        "p_color_main": "#ffffff",
+        "p_color_sub": "#444444",
+        "text_color": "#eeeeee",
+        "bg_rgba": "rgba(0, 0, 0, 0.6)",
+        "input_bg": "rgba(10, 10, 10, 0.9)",
+        "border_color": "rgba(255, 255, 255, 0.1)",
+        "mask_color": "#000000",
+    },
+}
+
+# ページ内に置くテーマ切替用の目印。CSS と背景 iframe の両方がこのクラスを見る
+THEME_MARKER_CLASS = "tomato-theme-dark"
+THEME_LIGHT_CLASS = "tomato-theme-light"
+# 目印はアプリ画面を描画している間だけある（ログイン画面にはない）
+_APP_SCOPE = f":root:has(.{THEME_LIGHT_CLASS}, .{THEME_MARKER_CLASS})"
+
+
+# ==============================================================================
+# 画像読み込み
+# ==============================================================================
+@st.cache_data
+def get_image_base64(filename: str) -> str:
+
+    if not filename:
+        return ""
+    full_path = BASE_DIR / filename
+    if full_path.exists():
+        with open(full_path, "rb") as f:
+            encoded = base64.b64encode(f.read()).decode("utf-8")
+        return f"data:image/png;base64,{encoded}"
+    print(f"[WARN] image not found: {full_path}")
+    return ""
+
+
+def theme_marker_html(dark_mode: bool) -> str:
+    """テーマ切替はこの小さな要素だけを差し替える（スタイル本体は固定）"""
+    cls = THEME_MARKER_CLASS if dark_mode else THEME_LIGHT_CLASS
+    return f'<div class="{cls}" style="display:none"></div>'
+
+
+# ==============================================================================
+# CSS（両テーマ分をカスタムプロパティで一度だけ組み立てる）
+# ==============================================================================
+_CSS_TEMPLATE = """
+    :root {
+__LIGHT_VARS__
+        --tl-accent: __ACCENT__;
+    }
+    :root:has(.__DARK_CLASS__) {
+__DARK_VARS__
+    }
+
+    /* iframe（背景）の設定 */
+    iframe[data-testid="stIFrame"] {
+        position: fixed !important;
+        top: 0 !important;
+        left: 0 !important;
+        width: 100vw !important;
+        height: 100vh !important;
+        z-index: 0 !important;
+        border: none !important;
+        pointer-events: auto !important; /* ★ここを auto に戻しました（粒子が動くようになります） */
+    }
+
+    /* 全体の背景透明化 */
+    .stApp { background: transparent !important; }
+    header, header > div { background: transparent !important; }
+
+    /* サイドバー開閉ボタン */
+    button[data-testid="stSidebarCollapsedControl"] {
+        color: var(--tl-text-color) !important;
+        background-color: var(--tl-bg-rgba) !important;
+        border-radius: 5px;
+        margin-top: 10px; margin-left: 10px;
+        z-index: 1001 !important;
+    }
+
+    /* サイドバー本体 */
+    section[data-testid="stSidebar"] {
+        background-color: var(--tl-input-bg) !important;
+        border-right: 1px solid var(--tl-border-color);
+    }
+    section[data-testid="stSidebar"] h1,
+    section[data-testid="stSidebar"] label,
+    section[data-testid="stSidebar"] span {
+        color: var(--tl-text-color) !important;
+    }
+
+    /* ヘッダー部分のマスク */
+    .title-mask {
+        position: fixed; top: 0; left: 0;
+        width: 100%; height: 100px;
+        background: var(--tl-mask-color);
+        background: linear-gradient(to bottom, var(--tl-mask-color) 60%, transparent);
+        z-index: 999;
+        pointer-events: none;
+    }
+
+    /* タイトル文字 */
+    h1 {
+        position: fixed !important;
+        top: 15px; left: 60px;
+        margin: 0 !important;
+        font-family: 'Arial', sans-serif;
+        font-weight: 900; font-size: 1.8rem !important;
+        letter-spacing: 2px;
+        color: var(--tl-text-color) !important;
+        text-shadow: 0 0 10px rgba(128,128,128,0.3);
+        z-index: 1000; pointer-events: none;
+    }
+
+    /* 入力欄の背景 */
+    div[data-testid="stBottom"] {
+        background: linear-gradient(
+            to top,
+            var(--tl-mask-color) 40%,
+            transparent 100%
+        ) !important;
+        z-index: 998;
+        padding-bottom: 0px !important;
+    }
+
+    div[data-testid="stBottom"] > div {
+        background: transparent !important;
+    }
+
+    div[data-testid="stChatInput"] {
+        width: 60% !important;
+        margin: 0 auto !important;
+        position: fixed !important;
+        bottom: 15px !important; /* 0pxにすると本当にベタ付けになります。10pxくらいが綺麗です */
+        left: 50% !important;
+        transform: translateX(-50%) !important; /* 真ん中に寄せるため */
+
+        z-index: 1000;
+        padding-bottom: 0px !important;
+    }
+
+    .stTextInput input, .stTextInput textarea {
+        background-color: var(--tl-input-bg) !important;
+        color: var(--tl-text-color) !important;
+        border: 1px solid var(--tl-border-color) !important;
+        border-radius: 12px !important;
+    }
+
+    /* ★メインコンテナのレイアウト調整 */
+    .block-container {
+        padding-top: 120px !important;
+        padding-bottom: 100px !important; /* ★ここを増やしました（一番下のメッセージが上がります） */
+        max-width: 1000px !important;
+        pointer-events: none;
+    }
+
+    /* チャットメッセージ */
+    div[data-testid="stChatMessage"] {
+        background-color: var(--tl-bg-rgba) !important;
+        border: 1px solid var(--tl-border-color);
+        border-left: 3px solid var(--tl-accent) !important;
+        border-radius: 4px;
+        backdrop-filter: blur(5px);
+        width: 90%; margin: 0 auto;
+        position: relative; z-index: 997;
+        pointer-events: none !important;
+    }
+    div[data-testid="stChatMessage"] div,
+    div[data-testid="stChatMessage"] p,
+    div[data-testid="stChatMessage"] code {
+        color: var(--tl-text-color) !important;
+        pointer-events: auto !important;
+    }
+    .katex { color: var(--tl-text-color) !important; pointer-events: auto !important; }
+    .katex-display { pointer-events: auto !important; }
+    /* 「以前のメッセージを表示」ボタン（メイン領域はクリックを透過させているため） */
+    .block-container div[data-testid="stButton"] { pointer-events: auto !important; }
+
+    /* ステータス表示 */
+    .prts-status {
+        position: fixed !important;
+        bottom: 5px; right: 10px;
+        font-family: 'Courier New', monospace;
+        color: var(--tl-text-color) !important;
+        z-index: 1000;
+        pointer-events: none;
+        text-align: right; font-size: 0.8em;
+        opacity: 0.8;
+    }
+"""
+
+_CSS_VAR_KEYS = ("text_color", "bg_rgba", "input_bg", "border_color", "mask_color")
+
+
+def _css_vars(palette: dict) -> str:
+    return "\n".join(
+        f"        --tl-{k.replace('_', '-')}: {palette[k]};" for k in _CSS_VAR_KEYS
+    )
+
+
+def _scope_css(css: str) -> str:
+    """
+    変数定義（:root）以外のルールに _APP_SCOPE を付け、アプリ画面の描画中だけ効くようにする。
+    <head> に残ったスタイルがログイン画面（入力欄・タイトル）に掛からないように。
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+
+    def scope(m):
+        selectors, body = m.group(1).strip(), m.group(2)
+        if selectors.startswith(":root"):
+            return f"\n{selectors} {{{body}}}"
+        scoped = ", ".join(f"{_APP_SCOPE} {sel.strip()}" for sel in selectors.split(","))
+        return f"\n{scoped} {{{body}}}"
+
+    return re.sub(r"([^{}]+)\{([^{}]*)\}", scope, css)
+
+
+@st.cache_data
+def build_theme_css(accent_color: str) -> str:
+    """両テーマ入りの静的 CSS（<style> タグなし。アプリ画面の描画中だけ効く）"""
+    return _scope_css(
+        _CSS_TEMPLATE
+        .replace("__LIGHT_VARS__", _css_vars(THEMES["light"]))
+        .replace("__DARK_VARS__", _css_vars(THEMES["dark"]))
+        .replace("__DARK_CLASS__", THEME_MARKER_CLASS)
+        .replace("__ACCENT__", accent_color)
+    )
+
+
+# ==============================================================================
+# 背景アニメーション HTML（両テーマの粒子を1つのコンポーネントに持つ）
+# ==============================================================================
+_BACKGROUND_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="ja">
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body { margin: 0; overflow: hidden; width: 100vw; height: 100vh; __LIGHT_BG__ transition: background 0.5s ease; }
+        body.dark { __DARK_BG__ }
+        canvas { display: block; width: 100%; height: 100%; }
+    </style>
+</head>
+<body>
+    <canvas id="canvas"></canvas>
+    <script>
+        // スタイル本体は親ページの <head> に入れ、この iframe が消えたら取り除く。
+        // iframe が作り直されたときは新しい方が引き継ぐ（古い方の pagehide で消さない）
+        const STYLE_ID = 'tomato-theme-css', THEME_CSS = __CSS__, CSS_HASH = '__CSS_HASH__';
+        const styleOwner = Math.random().toString(36).slice(2);
+        function installStyle() {
+            try {
+                const doc = window.parent.document;
+                let el = doc.getElementById(STYLE_ID);
+                if (!el) {
+                    el = doc.createElement('style');
+                    el.id = STYLE_ID;
+                    doc.head.appendChild(el);
+                }
+                if (el.dataset.hash !== CSS_HASH) {
+                    el.textContent = THEME_CSS;
+                    el.dataset.hash = CSS_HASH;
+                }
+                el.dataset.owner = styleOwner;
+            } catch (e) {}
+        }
+        function removeStyle() {
+            try {
+                const el = window.parent.document.getElementById(STYLE_ID);
+                if (el && el.dataset.owner === styleOwner) el.remove();
+            } catch (e) {}
+        }
+        installStyle();
+        window.addEventListener('pagehide', removeStyle);
+
+        const CONFIG = {
+            particleSize: 5.5,
+            particleMargin: 1,
+            repulsionRadius: 80,
+            repulsionForce: 2.5,
+            friction: 0.12,
+            returnSpeed: 0.015,
+            samplingStep: 4,
+            maxDisplayRatio: 0.7
+        };
+        const THEMES = __THEMES__;
+        const sets = { light: [], dark: [] }, images = {};
+        let current = 'light', mouse = { x: -1000, y: -1000 }, running = false;
+        const canvas = document.getElementById('canvas'), ctx = canvas.getContext('2d');
+        class Particle {
+            constructor(x, y, color) {
+                this.originalX = x; this.originalY = y;
+                this.x = x; this.y = y;
+                this.vx = 0; this.vy = 0;
+                this.baseColor = color;
+            }
+            update() {
+                const dx = this.x - mouse.x, dy = this.y - mouse.y;
+                const dist = Math.sqrt(dx*dx + dy*dy);
+                if (dist < CONFIG.repulsionRadius) {
+                    const angle = Math.atan2(dy, dx);
+                    const force = (CONFIG.repulsionRadius - dist) / CONFIG.repulsionRadius;
+                    const rep = force * force * CONFIG.repulsionForce;
+                    this.vx += Math.cos(angle) * rep;
+                    this.vy += Math.sin(angle) * rep;
+                }
+                this.vx += (this.originalX - this.x) * CONFIG.returnSpeed;
+                this.vy += (this.originalY - this.y) * CONFIG.returnSpeed;
+                this.vx *= (1 - CONFIG.friction);
+                this.vy *= (1 - CONFIG.friction);
+                this.x += this.vx;
+                this.y += this.vy;
+            }
+            draw() {
+                ctx.fillStyle = this.baseColor;
+                ctx.beginPath();
+                ctx.arc(this.x, this.y, CONFIG.particleSize/2, 0, Math.PI*2);
+                ctx.fill();
+            }
+        }
+        // 親ページの目印クラスを見てテーマを決める（Python 側は目印を差し替えるだけ）
+        function detectTheme() {
+            try {
+                return window.parent.document.querySelector('.__DARK_CLASS__') ? 'dark' : 'light';
+            } catch (e) {
+                return current;
+            }
+        }
+        function applyTheme(name) {
+            current = name;
+            document.body.classList.toggle('dark', name === 'dark');
+        }
+        function init() {
+            window.addEventListener('resize', () => {
+                resize();
+                Object.keys(images).forEach(name => generateParticles(name));
+            });
+            window.addEventListener('mousemove', e => {
+                mouse.x = e.clientX; mouse.y = e.clientY;
+            });
+            window.addEventListener('touchmove', e => {
+                mouse.x = e.touches[0].clientX; mouse.y = e.touches[0].clientY;
+            });
+            resize();
+            applyTheme(detectTheme());
+            Object.keys(THEMES).forEach(name => {
+                const src = THEMES[name].particleSrc;
+                if (!src) return;
+                const img = new Image();
+                img.src = src;
+                img.onload = () => { images[name] = img; generateParticles(name); start(); };
+            });
+            setInterval(() => {
+                const name = detectTheme();
+                if (name !== current) applyTheme(name);
+            }, 300);
+        }
+        function resize() {
+            canvas.width = window.innerWidth;
+            canvas.height = window.innerHeight;
+        }
+        function generateParticles(name) {
+            const img = images[name], theme = THEMES[name];
+            const list = [];
+            const temp = document.createElement('canvas');
+            const tCtx = temp.getContext('2d');
+            const tW = window.innerWidth * CONFIG.maxDisplayRatio;
+            const tH = window.innerHeight * CONFIG.maxDisplayRatio;
+            const scale = Math.min(tW / img.width, tH / img.height);
+            const w = Math.floor(img.width * scale);
+            const h = Math.floor(img.height * scale);
+            temp.width = w; temp.height = h;
+            tCtx.drawImage(img, 0, 0, w, h);
+            const data = tCtx.getImageData(0, 0, w, h).data;
+            const offX = (window.innerWidth - w) / 2;
+            const offY = (window.innerHeight - h) / 2;
+            for (let y = 0; y < h; y += CONFIG.samplingStep) {
+                for (let x = 0; x < w; x += CONFIG.samplingStep) {
+                    const i = (y * w + x) * 4;
+                    if (data[i + 3] > 128) {
+                        const b = (data[i] + data[i+1] + data[i+2]) / 3;
+                        list.push(new Particle(x+offX, y+offY, b > 128 ? theme.main : theme.sub));
+                    }
+                }
+            }
+            sets[name] = list;
+        }
+        function start() {
+            if (running) return;
+            running = true;
+            animate();
+        }
+        function animate() {
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            sets[current].forEach(p => { p.update(); p.draw(); });
+            requestAnimationFrame(animate);
+        }
+        init();
+    </script>
+</body>
+</html>
+"""
+
+
+def _bg_style(palette: dict, wallpaper_src: str) -> str:
+    if wallpaper_src:
+        return (
+            f"background-image: url('{wallpaper_src}');"
+            "background-size: cover; background-position: center;"
+        )
+    return f"background-color: {palette['bg_color']};"
+
+
+@st.cache_data
+def build_background_html(
+    accent_color: str,
+    particle_light: str,
+    particle_dark: str,
+    wallpaper_light: str = None,
+    wallpaper_dark: str = None,
+) -> str:
+    """
+    背景コンポーネントの HTML を一度だけ組み立てる（画像の引数はファイル名）。
+    両テーマの粒子画像とテーマ CSS を持ち、テーマ切替はブラウザ側で行うので HTML は常に同じ。
+    10KB を超える同一の要素は Streamlit が参照（ハッシュ）だけ送るので、
+    毎回出しても中身が再送されるのは最初の1回だけ。
+    """
+    css = build_theme_css(accent_color)
+    themes = {}
+    for name, particle in (("light", particle_light), ("dark", particle_dark)):
+        palette = THEMES[name]
+        themes[name] = {
+            "particleSrc": get_image_base64(particle),
+            "main": palette["p_color_main"],
+            "sub": palette["p_color_sub"],
+        }
+    return (
+        _BACKGROUND_TEMPLATE
+        .replace("__LIGHT_BG__", _bg_style(THEMES["light"], get_image_base64(wallpaper_light)))
+        .replace("__DARK_BG__", _bg_style(THEMES["dark"], get_image_base64(wallpaper_dark)))
+        .replace("__DARK_CLASS__", THEME_MARKER_CLASS)
+        .replace("__THEMES__", json.dumps(themes))
+        .replace("__CSS_HASH__", hashlib.sha256(css.encode("utf-8")).hexdigest()[:12])
+        .replace("__CSS__", json.dumps(css, ensure_ascii=False).replace("</", "<\\/"))
+    )
@@ -0,0 +1,127 @@
+# transcript_store.py
+import datetime
+import gzip
+import json
+import os
+import secrets
+import threading
+from pathlib import Path
+import streamlit as st
+
+JST = datetime.timezone(datetime.timedelta(hours=+9), 'JST')
+
+TRANSCRIPT_DIR = Path(
+    os.environ.get("TOMATO_TRANSCRIPT_DIR", Path(__file__).parent / "transcripts")
+)
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024  # これを超えたら次のセグメントへ
+INDEX_FILE = "index.jsonl"
+
+
+def strip_images(messages):
+    """会話コンテキストから画像データ（base64）を除いて保存用にする"""
+    out = []
+    for m in messages or []:
+        content = m.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get("type") == "text":
+                    parts.append(part.get("text", ""))
+                else:
+                    parts.append("[image]")
+            content = "\n".join(parts)
+        elif isinstance(content, (bytes, bytearray)):
+            content = "[image]"
+        out.append({"role": m.get("role"), "content": content})
+    return out
+
+
+class TranscriptStore:
+    """
+    全文トランスクリプトのローカル保存先（追記のみ）。
+    - 1件ずつ独立した gzip メンバーとしてセグメントファイルに追記する
+      （ファイル全体も通常の gzip としてそのまま読める）
+    - index.jsonl に (id, segment, offset, length) を追記し、1件だけの読み出しに使う
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = None  # id -> (segment, offset, length)。初回の get() で読み込む
+        self._segment = self._latest_segment()
+
+    def _latest_segment(self):
+        segments = sorted(self.root.glob("segment-*.jsonl.gz"))
+        if segments:
+            return segments[-1].name
+        return self._new_segment_name(0)
+
+    def _new_segment_name(self, seq: int) -> str:
+        return f"segment-{seq:06d}.jsonl.gz"
+
+    def _rotate_if_needed(self):
+        path = self.root / self._segment
+        if path.exists() and path.stat().st_size >= SEGMENT_MAX_BYTES:
+            seq = int(self._segment.split("-")[1].split(".")[0]) + 1
+            self._segment = self._new_segment_name(seq)
+
+    def append(self, record: dict) -> str:
+        """記録を追記して transcript ID を返す"""
+        now = datetime.datetime.now(JST)
+        transcript_id = f"{now.strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(4)}"
+        line = json.dumps(
+            {"id": transcript_id, "saved_at": now.isoformat(), **record},
+            ensure_ascii=False,
+        ) + "\n"
+        blob = gzip.compress(line.encode("utf-8"))
+
+        with self._lock:
+            self._rotate_if_needed()
+            path = self.root / self._segment
+            with open(path, "ab") as f:
+                offset = f.tell()
+                f.write(blob)
+            entry = {
+                "id": transcript_id,
+                "segment": self._segment,
+                "offset": offset,
+                "length": len(blob),
+            }
+            with open(self.root / INDEX_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            if self._index is not None:
+                self._index[transcript_id] = (entry["segment"], offset, len(blob))
+        return transcript_id
+
+    def _load_index(self):
+        index = {}
+        path = self.root / INDEX_FILE
+        if path.exists():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue  # 書き込み途中の行は無視
+                    index[e["id"]] = (e["segment"], e["offset"], e["length"])
+        return index
+
+    def get(self, transcript_id: str):
+        """transcript ID から1件を読み出す（見つからなければ None）"""
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            loc = self._index.get(transcript_id.strip())
+        if not loc:
+            return None
+        segment, offset, length = loc
+        with open(self.root / segment, "rb") as f:
+            f.seek(offset)
+            blob = f.read(length)
+        return json.loads(gzip.decompress(blob).decode("utf-8"))
+
+
+@st.cache_resource
+def get_transcript_store() -> TranscriptStore:
+    return TranscriptStore(TRANSCRIPT_DIR)
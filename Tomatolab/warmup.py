@@ -0,0 +1,53 @@
+# warmup.py
+import threading
+import time
+import streamlit as st
+from ai_client import get_openai_client
+from sheets_utils import (
+    get_cached_gspread_client,
+    get_log_sheet,
+    get_student_sheet,
+    load_roster,
+)
+
+
+def _warm_openai():
+    client = get_openai_client()
+    if client is None:
+        return
+    # 軽い GET を1回投げて TLS 接続を張っておく
+    client.models.retrieve("gpt-4o-mini")
+
+
+# 最初の生徒が来る前に済ませておく処理（上から順に実行）
+PREWARM_STEPS = [
+    ("gspread auth", get_cached_gspread_client),
+    ("open log sheet", get_log_sheet),
+    ("open student sheet", get_student_sheet),
+    ("load roster", load_roster),
+    ("openai connection", _warm_openai),
+]
+
+
+def _prewarm():
+    started = time.perf_counter()
+    for name, step in PREWARM_STEPS:
+        t0 = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"Prewarm Error ({name}): {e}")
+            continue
+        print(f"[prewarm] {name}: {time.perf_counter() - t0:.2f}s")
+    print(f"[prewarm] done in {time.perf_counter() - started:.2f}s")
+
+
+@st.cache_resource
+def start_prewarm():
+    """
+    サーバ起動後の最初の実行で1度だけ、バックグラウンドでウォームアップを始める。
+    ログイン画面の表示はこれを待たない。
+    """
+    thread = threading.Thread(target=_prewarm, name="tomato-prewarm", daemon=True)
+    thread.start()
+    return thread